@@ -4,6 +4,14 @@ import numpy as np
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
 import xml.etree.ElementTree as et
+import html, mmap, multiprocessing, pickle, sqlite3
+from functools import lru_cache
+from xml_parser_common import (ColumnAccumulator, HistogramMatrixWriter, anonymize, compile_extraction_plan,
+                               covid_assessment_labels, extract_comorbidities_freetxt, faulty_date_threshold,
+                               faulty_logs, get_assessment_id, get_faulty_dates, get_histogramm, get_output_formats,
+                               histogram_bin_edges, histogram_hu_thresholds, histogram_percentiles, iter_case_batches,
+                               iter_cases, map_case_batches, normalize_lesions, sqlite_database_name,
+                               update_date_columns, write_histogram_metadata, write_output)
 
 required_parameters_risk_model = {
     "Arztbrief/KIS Angaben": {
@@ -427,41 +435,6 @@ date_columns_cov_rads = ['CT//StudyDate',
                 'Laborparameter//Virologie::Datum des vorherigen RT-PCR-Tests'
                 ]
 
-comorbidities_base = 'Klinisch-anamnestische Information//Komorbiditäten aus Arztbrief'
-comorbidities_org = f'{comorbidities_base}::Andere Komorbiditäten'
-comorbidities_date = f'{comorbidities_base}::Datum'
-comorbidities_study_type = f'{comorbidities_base}::Untersuchungstyp'
-comorbidities_dia = f'{comorbidities_base}::Diastolischer Blutdruck'
-comorbidities_new = [comorbidities_date, comorbidities_study_type, comorbidities_dia]
-
-
-def extract_date(s, regex=r'\d{4}[.-]\d{1,2}[.-]\d{1,2}', str_pattern='%Y-%m-%d', return_string=False):
-    # Return np.nan if no date is found (in order to handle this column subsequently)
-    try:
-        match = re.search(regex, s)
-        # Handle date format '%d.%m.%Y' if '%Y-%m-%d' (or similar ones) cannot be found
-        if match is None:
-            match = re.search(r'\d{2}.\d{2}.\d{4}', s)
-            if match is None:
-                return np.nan
-            else:
-                date_str = match.group()
-                return date_str if return_string else datetime.strptime(date_str, '%d.%m.%Y').date()
-        date_str = match.group()
-        # Replace separator between year, month and date with '-'
-        date_str = date_str.replace('.', '-')
-        # If month digits are larger than 12, then we assume date pattern to be '%Y-%d-%m' instead of '%Y-%m-%d'
-        if int(date_str.split('-')[1]) > 12:
-            return date_str if return_string else datetime.strptime(date_str, '%Y-%d-%m').date()
-        else:
-            return date_str if return_string else datetime.strptime(date_str, str_pattern).date()
-    except TypeError:
-        return np.nan
-    except AttributeError:
-        return np.nan
-    except:
-        return np.nan
-
 
 def encrypt_id(s):
     hash_object = hashlib.sha256(s.encode())
@@ -469,27 +442,141 @@ def encrypt_id(s):
     return hash_string
 
 
+re_template_digit = re.compile(r'\([0-9]*\)')
+
+
+@lru_cache(maxsize=None)
 def clean_template_name(t):
     t = t.replace('RACOON COVID-19 ', '')
-    re_digit = re.compile(r'\([0-9]*\)')
-    search_digit = re_digit.search(t)
+    search_digit = re_template_digit.search(t)
     if search_digit:
         t = t.replace(f' {search_digit[0]}', '')
     return t
 
 
-def get_cases(r):
-    """ Get a list of all cases in an XML file with root r.
+re_case_start = re.compile(rb'<Case(?:\s(?:[^>"\']|"[^"]*"|\'[^\']*\')*)?/?>')
+re_case_end = re.compile(rb'</Case\s*>')
+re_patient_tag = re.compile(rb'<Patient(?:\s(?:[^>"\']|"[^"]*"|\'[^\']*\')*)?/?>')
+re_assessment_tag = re.compile(rb'<Assessment(?:\s(?:[^>"\']|"[^"]*"|\'[^\']*\')*)?/?>')
+
+
+def get_tag_attribute(tag, name):
+    """ Get the (unescaped) value of an attribute from the raw bytes of a start tag, None if it is not given. """
+    match = re.search(rb'\s' + name.encode() + rb'\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', tag)
+    if match is None:
+        return None
+    value = match.group(1) if match.group(1) is not None else match.group(2)
+    return html.unescape(value.decode('utf-8'))
+
+
+def get_case_index_file(input_file):
+    # The sidecar must not end with .xml, otherwise it would be found as input file
+    return f'{os.path.splitext(input_file)[0]}.caseindex.json'
+
+
+def build_case_index(input_file, index_file=None):
+    """ Scan the raw bytes of an XML file once and write a sidecar index of all cases.
+
+    For every case the index stores its byte range together with CaseID, PatientID and the contained AssessmentIDs,
+    so that single cases can be parsed later on without reading the whole file. The scan assumes a UTF-8 encoded
+    export without nested Case tags.
 
     Args:
-        r: root of the XML file
+        input_file: Path to the XML file
+        index_file: Path of the sidecar file, defaults to '<name of the XML file>.caseindex.json'.
 
     Returns:
-        list: List of all cases.
+        dict: Case index, see load_case_index.
     """
-    return [case for trial in r.iter('Trial')
-            for trial_arm in trial.iter('TrialArm')
-            for case in trial_arm.iter('Case')]
+    if index_file is None:
+        index_file = get_case_index_file(input_file)
+    cases = []
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = 0
+        while True:
+            start_tag = re_case_start.search(mm, position)
+            if start_tag is None:
+                break
+            if start_tag.group().endswith(b'/>'):
+                end = start_tag.end()
+            else:
+                end_tag = re_case_end.search(mm, start_tag.end())
+                if end_tag is None:
+                    print(f'WARNING::Case at byte {start_tag.start()} is not closed, stop indexing')
+                    break
+                end = end_tag.end()
+            patient_id = None
+            for patient_tag in re_patient_tag.finditer(mm, start_tag.start(), end):
+                patient_id = get_tag_attribute(patient_tag.group(), 'PatientID')
+            assessment_ids = [get_tag_attribute(assessment_tag.group(), 'AssessmentID')
+                              for assessment_tag in re_assessment_tag.finditer(mm, start_tag.start(), end)]
+            cases.append({'index': len(cases),
+                          'offset': start_tag.start(),
+                          'length': end - start_tag.start(),
+                          'CaseID': get_tag_attribute(start_tag.group(), 'CaseID'),
+                          'PatientID': patient_id,
+                          'AssessmentIDs': assessment_ids})
+            position = end
+    stat = os.stat(input_file)
+    case_index = {'file': os.path.basename(input_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                  'cases': cases}
+    with open(index_file, 'w', encoding='utf-8') as json_file:
+        json.dump(case_index, json_file, ensure_ascii=False)
+    print(f'INFO::Indexed {len(cases)} cases in {index_file}')
+    return case_index
+
+
+def load_case_index(input_file, index_file=None):
+    """ Load the sidecar index of an XML file, it is (re-)built if it is missing or outdated.
+
+    Args:
+        input_file: Path to the XML file
+        index_file: Path of the sidecar file, defaults to '<name of the XML file>.caseindex.json'.
+
+    Returns:
+        dict: Case index with file size and modification time of the indexed file and a list of cases, each given as
+              dictionary with the keys index, offset, length, CaseID, PatientID and AssessmentIDs.
+    """
+    if index_file is None:
+        index_file = get_case_index_file(input_file)
+    if os.path.exists(index_file):
+        with open(index_file, encoding='utf-8') as json_file:
+            case_index = json.load(json_file)
+        stat = os.stat(input_file)
+        if case_index['size'] == stat.st_size and case_index['mtime_ns'] == stat.st_mtime_ns:
+            return case_index
+        print(f'INFO::Case index {index_file} is outdated')
+    return build_case_index(input_file, index_file)
+
+
+def select_cases(case_index, case_ids=None, patient_ids=None):
+    """ Select the index entries of the given cases and patients, all cases are selected if neither is given. """
+    if case_ids is None and patient_ids is None:
+        return case_index['cases']
+    case_ids = set(case_ids or [])
+    patient_ids = set(patient_ids or [])
+    return [entry for entry in case_index['cases'] if entry['CaseID'] in case_ids or entry['PatientID'] in patient_ids]
+
+
+def read_case_ranges(input_file, ranges):
+    """ Read the raw bytes of the given (offset, length) ranges from an XML file. """
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return [mm[offset:offset + length] for offset, length in ranges]
+
+
+def iter_indexed_cases(input_file, entries):
+    """ Parse only the given cases of an XML file using their byte ranges from the case index.
+
+    Args:
+        input_file: Path to the XML file
+        entries: Index entries of the cases, see select_cases.
+
+    Yields:
+        xml.etree.ElementTree.Element: Next selected case.
+    """
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for entry in entries:
+            yield et.fromstring(mm[entry['offset']:entry['offset'] + entry['length']])
 
 
 def create_empty_dataframe(params, additional_columns=None):
@@ -499,25 +586,109 @@ def create_empty_dataframe(params, additional_columns=None):
         params: Dictionary containing the names of the required parameters.
 
     Returns:
-        pd.Dataframe: Empty dataframe for case information.
+        ColumnAccumulator: Empty accumulator for case information, use to_dataframe() to obtain the dataframe.
 
     """
-    data_dict = {'PatientID': [], 'Template': []}
+    columns = ['PatientID', 'Template', 'AssessmentID']
     if additional_columns is not None:
-        for col in additional_columns:
-            data_dict.update({col: []})
+        columns.extend(additional_columns)
     for template in list(params):
         for group in params[template]:
             for question in params[template][group]:
-                data_dict.update({f'{template}//{group}::{question}': []})
-    return pd.DataFrame(data_dict)
+                columns.append(f'{template}//{group}::{question}')
+    return ColumnAccumulator(columns)
+
 
+class AnswerIndex:
+    """ Index of the answers of a case, built in a single traversal of the case.
 
-def get_study_dates(r):
+    Every project reads the answers from the index instead of walking the case again:
+
+    - tasks: All tasks (templates) of the case in document order.
+    - task_answers: Answers of each task, mapping (group header, question) -> answer.
+    - lesions: All lesions of the case in document order.
+    - lesion_answers: Answers of the assessed questions of each lesion, mapping label -> answer.
+    - attribute_answers: Answers of all questions of the case by their Question, Label and Text attributes, mapping
+      (attribute, value) -> answer. attribute_positions keeps the order in which the keys appear first.
+    - assessment_studies: DICOM studies of each assessment.
+
+    Questions without answer are not indexed. If a key occurs more than once, the last answer is kept. The bins of
+    the histograms are skipped.
+
+    Args:
+        case: Current case (XML element)
+
+    """
+
+    def __init__(self, case):
+        self.tasks = []
+        self.task_answers = {}
+        self.lesions = []
+        self.lesion_answers = {}
+        self.attribute_answers = {}
+        self.attribute_positions = {}
+        self.assessment_studies = {}
+        self.add_element(case, None, (), (), ())
+
+    def add_element(self, element, task, groups, lesions, assessments):
+        tag = element.tag
+        if tag == 'Question':
+            self.add_question(element, task, groups, lesions)
+        elif tag == 'Task':
+            task, groups = element, ()
+            self.tasks.append(task)
+            self.task_answers[task] = {}
+        elif tag == 'Group':
+            groups = groups + (element.attrib.get('Header'),)
+        elif tag == 'Lesion':
+            lesions = lesions + (element,)
+            self.lesions.append(element)
+            self.lesion_answers[element] = {}
+        elif tag == 'Assessment':
+            assessments = assessments + (element,)
+            self.assessment_studies[element] = []
+        elif tag == 'DicomStudy':
+            for assessment in assessments:
+                self.assessment_studies[assessment].append(element)
+        elif tag == 'Histogram':
+            # Histograms only contain bins, they are read separately by get_histogramm
+            return
+        for child in element:
+            self.add_element(child, task, groups, lesions, assessments)
+
+    def add_question(self, question, task, groups, lesions):
+        attrib = question.attrib
+        answer = attrib.get('Answer')
+        if answer is None:
+            return
+        for attribute in ('Question', 'Label', 'Text'):
+            value = attrib.get(attribute)
+            if value is not None:
+                self.attribute_answers[attribute, value] = answer
+                self.attribute_positions.setdefault((attribute, value), len(self.attribute_positions))
+        question_name = attrib.get('Question')
+        if task is not None and question_name is not None:
+            task_answers = self.task_answers[task]
+            for group in groups:
+                task_answers[group, question_name] = answer
+        label = attrib.get('Label')
+        if lesions and label is not None and attrib.get('Assessed') == 'true':
+            for lesion in lesions:
+                self.lesion_answers[lesion][label] = answer
+
+
+def get_study_dates(answers):
+    """ Collect the CT study date of every assessment of a case.
+
+    Args:
+        answers: AnswerIndex of the case.
+
+    Returns:
+        dict: Mapping of assessment ID to study date.
+    """
     study_dates_dict = {}
-    for assessment in r.iter('Assessment'):
+    for assessment, dcm_studies in answers.assessment_studies.items():
         assessment_id = assessment.attrib['AssessmentID']
-        dcm_studies = list(assessment.iter('DicomStudy'))
         if len(dcm_studies) > 1:
             print(
                 f'WARNING::There is more than one dicom study in assessment ID {assessment_id}')
@@ -525,191 +696,131 @@ def get_study_dates(r):
         for dcm_study in dcm_studies:
             study_date = dcm_study.attrib['StudyDate']
             study_dates_dict.update({assessment_id: study_date})
-    return pd.DataFrame(study_dates_dict.items(), columns=['CT//AssessmentID', 'CT//StudyDate'])
+    return study_dates_dict
+
+
+def keep_patients_with_template(df, template):
+    """ Keep only the patients that have at least one row of the given template.
+
+    Args:
+        df: Dataframe containing the columns PatientID and Template.
+        template: Name of the template, e.g. 'CT'.
+
+    Returns:
+        pd.DataFrame: Rows of all patients having the template.
+
+    """
+    has_template = (df['Template'] == template).groupby(df['PatientID'], sort=False).any()
+    return df[df['PatientID'].isin(has_template.index[has_template])]
 
 
 def remove_non_ct_patients(df):
-    patients = df['PatientID'].unique().tolist()
-    non_ct = [patient for patient in patients if len(df[(df['PatientID'] == patient) & (df['Template'] == 'CT')]) == 0]
-    return df[~df['PatientID'].isin(non_ct)]
-
-
-def extract_earliest_ct_dates(cts):
-    earliest_ct_dates = {}
-    non_ct_date_patients = []
-    for patient, dates in cts.items():
-        if np.nan in dates:
-            dates.remove(np.nan)
-
-        if len(dates) > 0:
-            converted_dates = [datetime.strptime(t, '%Y-%m-%d') for t in dates]
-            earliest_date = min(converted_dates)
-            earliest_ct_dates[patient] = earliest_date
-        else:
-            print(f'WARNING::There is no CT date extracted for any CT of patient {patient}')
-            non_ct_date_patients.append(patient)
-    return earliest_ct_dates, non_ct_date_patients
-
-
-def extract_n_days(df, patients_list):
-    n_days = {}
-    for patient in patients_list:
-        patient_days = df[df['PatientID'] == patient][
-            'Arztbrief/KIS Angaben//Arztbrief/KIS Angaben::Tage seit Aufnahme'].unique().tolist()
-        if np.nan in patient_days:
-            patient_days.remove(np.nan)
-        # Assumption: If there is an empty string, we assume the number of days since admission to be 0
-        # patient_days = [int(d) if d != '' else 0 for d in patient_days]
-        patient_days = [int(d) for d in patient_days if isinstance(d, int)]
-        # In case there is an empty sequence of patient_days, i.e., there is no such number specified, we assume it to be 0
-        if len(patient_days) > 0:
-            n_days[patient] = min(patient_days)
-        else:
-            n_days[patient] = 0
-    return n_days
+    return keep_patients_with_template(df, 'CT')
 
 
-def list_diff(li1, li2):
-    li_dif = [i for i in li1 + li2 if i not in li1 or i not in li2]
-    return li_dif
+def extract_earliest_ct_dates(df):
+    """ Get the earliest CT study date of each patient.
 
+    Args:
+        df: Dataframe containing the columns PatientID and CT//StudyDate.
 
-def calculate_baseline_date(df):
-    patients = df['PatientID'].unique().tolist()
-    ct_dates = {patient: df[df['PatientID'] == patient]['CT//StudyDate'].unique().tolist() for patient in patients}
+    Returns:
+        tuple: Series mapping each patient with at least one CT study date to the earliest date and list of the
+               patients without any CT study date.
 
-    # Extract earliest date from list of CT dates
-    earliest_ct_dates, non_ct_date_patients = extract_earliest_ct_dates(ct_dates)
-    rel_patients = list_diff(patients, non_ct_date_patients)
+    """
+    ct_dates = pd.to_datetime(df['CT//StudyDate'], format='%Y-%m-%d')
+    earliest_ct_dates = ct_dates.groupby(df['PatientID'], sort=False).min()
+    non_ct_date_patients = earliest_ct_dates.index[earliest_ct_dates.isna()].tolist()
+    if len(non_ct_date_patients) > 0:
+        print(f'WARNING::There is no CT date extracted for any CT of {len(non_ct_date_patients)} patients: '
+              f'{", ".join(str(patient) for patient in non_ct_date_patients)}')
+    return earliest_ct_dates.dropna(), non_ct_date_patients
 
-    # Get minimum number of days since admission for each patient
-    n_days = extract_n_days(df, patients)
 
-    # Calculate baseline date for each patient
-    baselines = {patient: earliest_ct_dates[patient] - timedelta(days=n_days[patient]) for patient in rel_patients}
+def extract_n_days(df):
+    """ Get the minimum number of days since admission of each patient, 0 if there is no such number specified.
+
+    Args:
+        df: Dataframe containing the columns PatientID and 'Tage seit Aufnahme'.
 
-    return baselines, pd.DataFrame(baselines.items(), columns=['PatientID', 'Baseline Date Calculated']), non_ct_date_patients
+    Returns:
+        pd.Series: Minimum number of days for each patient.
 
+    """
+    patient_days = df['Arztbrief/KIS Angaben//Arztbrief/KIS Angaben::Tage seit Aufnahme']
+    patient_days = pd.to_numeric(patient_days, errors='coerce')
+    # In case there is an empty sequence of patient_days, i.e., there is no such number specified, we assume it to be 0
+    return patient_days.groupby(df['PatientID'], sort=False).min().fillna(0)
 
-def get_time_difference(baseline, reference):
-    try:
-        if isinstance(reference, float):
-            return reference
-        return (reference - baseline).days
-    except TypeError:
-        return reference
 
+def calculate_baseline_date(df):
+    # Extract earliest date from CT dates
+    earliest_ct_dates, non_ct_date_patients = extract_earliest_ct_dates(df)
 
-def replace_date(baseline_date, reference_value):
-    if isinstance(reference_value, float):
-        return reference_value
-    reference_date = extract_date(reference_value)
-    return get_time_difference(baseline_date, reference_date)
+    # Get minimum number of days since admission for each patient
+    n_days = extract_n_days(df)
 
+    # Calculate baseline date for each patient
+    baselines = earliest_ct_dates - pd.to_timedelta(n_days.reindex(earliest_ct_dates.index), unit='D')
+    baseline_dates = baselines.rename('Baseline Date Calculated').rename_axis('PatientID').reset_index()
 
-def update_date_columns(df, dc):
-    for col in dc:
-        df[col] = df.apply(lambda row: replace_date(row['Baseline Date Calculated'], row[col]), axis=1)
-    return df
+    return baselines.to_dict(), baseline_dates, non_ct_date_patients
 
 
-def extract_study_type(txt):
-    if isinstance(txt, float):
-        return txt
-    txt = txt.lower()
-    study_types = []
-    if 'base' in txt:
-        study_types.append('Baseline')
-    if 'ct' in txt:
-        study_types.append('CT')
-    if 'zwi' in txt:
-        study_types.append('Zwischenwert')
-    return ', '.join(study_types)
+class PseudonymVault:
+    """ Persistent pseudonyms of the PatientIDs, stored in a SQLite database.
 
+    Each PatientID gets a random UUID when it is seen for the first time, later exports reuse it. The pseudonyms are
+    therefore stable across runs and across the outputs of all projects. The vault links the pseudonyms to the
+    original PatientIDs and has to be kept as private as the XML export itself.
+    """
 
-def extract_dia(s):
-    try:
-        if s == 'Nicht beantwortet':
-            return s
-        s_mod = s.lower()
-        match = re.search(r'dia#\d{2,3}', s_mod)
-        if match is not None:
-            return match.group().replace('dia#', '')
-        match = re.search(r'dia\d{2,3}', s_mod)
-        if match is not None:
-            return match.group().replace('dia', '')
-        return np.nan
-    except TypeError:
-        return s
-    except AttributeError:
-        return s
-
-
-def extract_comorbidities_freetxt(df):
-    df[comorbidities_date] = df.apply(
-        lambda row: get_time_difference(row['Baseline Date Calculated'], extract_date(row[comorbidities_org])), axis=1)
-    df[comorbidities_study_type] = df.apply(lambda row: extract_study_type(row[comorbidities_org]), axis=1)
-    df[comorbidities_dia] = df.apply(lambda row: extract_dia(row[comorbidities_org]), axis=1)
-
-    # Update column order
-    columns = df.columns.tolist()
-    for col in comorbidities_new:
-        columns.remove(col)
-    rel_index = columns.index(comorbidities_org)
-    new_col_order = columns[:rel_index] + comorbidities_new + columns[(rel_index + 1):]
-
-    return df[new_col_order]
-
-
-def faulty_logs(df):
-    with open('extraction_info.txt', 'w') as f:
-        f.write(
-            'In diesem Dokument werden alle Patienten IDs aufgeführt, welche auffällige Werte in den verschiedenen Datumsfeldern haben.\nAuffällig sind hier insbesondere Werte, welche einen Abstand von über 90 Tagen zum berechneten Baseline-Datum aufweisen.\nBitte überprüfen Sie diese IDs auf Richtigkeit und führen Sie den Parser anschließend ggf. erneut aus.')
-        f.write(
-            '\n\nWICHTIG: Bitte teilen Sie dieses Dokument NICHT mit uns oder anderen Standorten, da durch die IDs ansonsten personenbezogene Informationen geteilt werden.')
-    faulty_dict = {}
-
-    for col in date_columns:
-        faulty_ids = set(df[df[col] > 90]['PatientID'])
-        if len(faulty_ids) > 0:
-            for id_ in faulty_ids:
-                if id_ in faulty_dict:
-                    faulty_dict[id_].append(col)
-                else:
-                    faulty_dict[id_] = [col]
-
-    with open('extraction_info.txt', 'a') as f:
-        for id_, columns in faulty_dict.items():
-            f.write(f'\n\nID: {id_}')
-            for col in columns:
-                f.write(f'\n\t{col}')
-            f.write('\n--------------------------------------------------------------------------------')
-
-    return df
-
-
-def anonymize_id(pid, uids):
-    try:
-        return uids[pid]
-    except KeyError:
-        return uuid.uuid4()
+    def __init__(self, vault_file):
+        self.connection = sqlite3.connect(vault_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pseudonyms (patient_id TEXT PRIMARY KEY, pseudonym TEXT)')
+
+    def get(self, patient_ids, chunk_size=500):
+        """ Get the pseudonyms of the given distinct PatientIDs as dictionary, missing ones are created and stored. """
+        keys = [str(id_) for id_ in patient_ids]
+        stored = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rows = self.connection.execute(f'SELECT patient_id, pseudonym FROM pseudonyms '
+                                           f'WHERE patient_id IN ({", ".join("?" * len(chunk))})', chunk)
+            stored.update(rows)
+        new_entries = [(key, str(uuid.uuid4())) for key in dict.fromkeys(keys) if key not in stored]
+        if new_entries:
+            with self.connection:
+                self.connection.executemany('INSERT INTO pseudonyms VALUES (?, ?)', new_entries)
+            stored.update(new_entries)
+        return {id_: uuid.UUID(stored[key]) for id_, key in zip(patient_ids, keys)}
+
+    def close(self):
+        self.connection.close()
 
 
-def anonymize(df, uids):
-    df['PatientID'] = df.apply(lambda row: anonymize_id(row['PatientID'], uids), axis=1)
-    return df
+def get_replacements(patient_ids, vault=None):
+    """ Get the pseudonyms of the given distinct PatientIDs, stable ones from the vault or new random UUIDs. """
+    if vault is None:
+        return {id_: uuid.uuid4() for id_ in patient_ids}
+    return vault.get(patient_ids)
 
 
-def get_template_information(d, c, params, patient_index):
-    """ Extract all template information for a given case.
+def get_generated_patient_id(patient_index):
+    """ Generate the patient ID of a case that does not provide one from its index. """
+    return f'Patient_{patient_index:03d}'
+
+
+def get_patient_id(c, patient_index):
+    """ Get the patient ID of a given case.
 
     Args:
-        d: Dataframe containing information about previous cases.
         c: Current case (XML element)
-        params: Dictionary containing the names of the required parameters.
+        patient_index: Index of the case, used to generate a new patient ID if the case does not provide one.
 
     Returns:
-        pd.DataFrame: Dataframe containing update case information
+        str: Patient ID of the case.
 
     """
     # patient_id = c[0].attrib['PatientID']
@@ -719,60 +830,75 @@ def get_template_information(d, c, params, patient_index):
             patient_id = p.attrib['PatientID']
     except KeyError:
         print(f'WARNING::Patient tag available but no PatientID. New PatientID will be generated for patient {patient_index}')
-        patient_id = f'Patient_{patient_index:03d}'
+        patient_id = get_generated_patient_id(patient_index)
     except Exception as e:
         print(f'WARNING::New PatientID will be generated for patient {patient_index} due to unhandled exception when targeting PatientID: {e}')
-        patient_id = f'Patient_{patient_index:03d}'
+        patient_id = get_generated_patient_id(patient_index)
     if patient_id is None:
         print(f'WARNING::No patient tag available. New PatientID will be generated for patient {patient_index}')
-        patient_id = f'Patient_{patient_index:03d}'
-    templates = list(c.iter('Task'))
-    for j, template in enumerate(templates):
-        try:
-            template_name = clean_template_name(template.attrib['Header'])
-            if template_name not in params.keys():
-                continue
-            template_dict = {'PatientID': patient_id, 'Template': template_name}
-            if template_name == 'CT':
-                template_dict.update({'CT//AssessmentID': template.attrib['AssessmentID']})
-            for group in template.iter('Group'):
-                group_name = group.attrib['Header']
-                if group_name in params[template_name]:
-                    for question in group.iter('Question'):
-                        question_name = question.attrib['Question']
-                        if question_name in params[template_name][group_name]:
-                            answer_name = question.attrib['Answer']
-                            template_dict.update({f'{template_name}//{group_name}::{question_name}': answer_name})
-            d = d.append(template_dict, ignore_index=True)
-        except KeyError:
-            template_name = clean_template_name(template.attrib['Header'])
-            print(f'ERROR::KeyError with key {template_name}')
-    return d
+        patient_id = get_generated_patient_id(patient_index)
+    return patient_id
 
 
-def main(required_parameters,
-         date_cols,
-         all_cases,
-         anonymization='UUID4',
-         additional_columns=None):
-    if isinstance(required_parameters, str):
-        with open(required_parameters, encoding='utf-8') as json_file:
-            required_parameters = json.load(json_file)
+def get_patient_hash(c, patient_index):
+    """ Get the SHA256 hash of CaseID, LastName, PatientID and InstitutionName of a given case as patient ID.
+
+    Args:
+        c: Current case (XML element)
+        patient_index: Index of the case, a generated patient ID is hashed if the case does not provide all attributes.
+
+    Returns:
+        str: Hashed patient ID of the case.
+
+    """
+    patient = c.find('Patient')
+    try:
+        patient_id = c.attrib['CaseID'] + patient.attrib['LastName'] + patient.attrib['PatientID'] + patient.attrib[
+            'InstitutionName']
+    except (AttributeError, KeyError) as e:
+        print(f'WARNING::Patient attribute {e} not available. Hashed PatientID will be generated for patient '
+              f'{patient_index}')
+        patient_id = get_generated_patient_id(patient_index)
+    return encrypt_id(patient_id)
+
+
+# Strategies to resolve the patient ID of a case, selected by name
+patient_identities = {'PatientID': get_patient_id, 'SHA256': get_patient_hash}
+
+
+def get_task_information(task_answers, template_plan, values):
+    """ Extract the required information of a single task (template).
+
+    Args:
+        task_answers: Answers of the task, mapping (group header, question) -> answer, see AnswerIndex.
+        template_plan: Compiled extraction plan of the template, mapping group -> question -> column index.
+        values: Row to fill, list containing one value for each column of the accumulator.
 
-    n_cases = len(all_cases)
-    data = create_empty_dataframe(params=required_parameters, additional_columns=additional_columns)
+    Returns:
+        list: Row containing the template information.
 
-    print(f'INFO::Extracting case information')
-    for i, case in enumerate(all_cases):
-        if i % 100 == 0: 
-            print(f'INFO::Currently handling case: {i}/{n_cases}')
-        data = get_template_information(d=data, c=case, params=required_parameters, patient_index=i)
+    """
+    for (group, question), answer in task_answers.items():
+        group_plan = template_plan.get(group)
+        if group_plan is None:
+            continue
+        column_index = group_plan.get(question)
+        if column_index is not None:
+            values[column_index] = answer
+    return values
 
-    # Extract CT study dates
-    print('INFO::Extract CT study dates from XML file')
-    study_dates = get_study_dates(root)
-    data = pd.merge(left=data, right=study_dates, on='CT//AssessmentID', how='left')
 
+def process_template_data(data, date_cols):
+    """ Post-process the extracted template information of a project.
+
+    Args:
+        data: Dataframe containing the extracted template information, including the CT study dates.
+        date_cols: Date columns that are converted relatively to the baseline date.
+
+    Returns:
+        pd.DataFrame: Post-processed dataframe.
+
+    """
     # Remove patients without CT template
     data = remove_non_ct_patients(data)
 
@@ -798,14 +924,28 @@ def main(required_parameters,
 
     # Move column CT//StudyDate
     ct_study_date = data.pop('CT//StudyDate')
-    data.insert(loc=5, column='CT//StudyDate', value=ct_study_date)
-
-    # Logging for faulty date columns
-    # data = faulty_logs(data)
+    data.insert(loc=6, column='CT//StudyDate', value=ct_study_date)
 
     # Anonymize data
     # data = anonymize(data)
 
+    return data
+
+
+def main(required_parameters,
+         date_cols,
+         cases,
+         anonymization='UUID4',
+         additional_columns=None,
+         workers=1):
+    template_visitor = TemplateVisitor(required_parameters, additional_columns=additional_columns)
+    identity = 'SHA256' if anonymization == 'SHA256' else 'PatientID'
+
+    print(f'INFO::Extracting case information and CT study dates')
+    extract_cases(cases, [template_visitor], workers=workers, identity=identity)
+
+    data = process_template_data(template_visitor.accumulator.to_dataframe(), date_cols)
+
     info = 'all'
     print("INFO::Data won't be filtered for certain patients")
 
@@ -822,74 +962,37 @@ def getpresternal(referenzmessung):
 
 
 # parse dicom tag information from which the lesion was measured
-def get_dicom_info(lesion):
-    dicom_information = {}
+@lru_cache(maxsize=None)
+def get_study_id(study_uid, study_date):
+    """ Get the pseudonymous StudyID of a DICOM study, the SHA256 hash of its StudyUID and StudyDate.
 
-    for MeasurementRecord in lesion[1].iter('MeasurementRecord'):
-        StudyDescription = MeasurementRecord.attrib['StudyDescription']
-        SeriesDescription = MeasurementRecord.attrib['SeriesDescription']
-        SliceThickness = MeasurementRecord.attrib['SliceThickness']
-        PixelSpacing = MeasurementRecord.attrib['PixelSpacing0']
-        string2hash = MeasurementRecord.attrib['StudyUID'] + MeasurementRecord.attrib['StudyDate']
-        StudyID = encrypt(string2hash)
-
-        dicom_information = dict(StudyID=StudyID,
-                                 StudyDescription=StudyDescription,
-                                 SeriesDescription=SeriesDescription,
-                                 SliceThickness=SliceThickness,
-                                 PixelSpacing=PixelSpacing)
-    return dicom_information
-
-
-# takes the histogramm in the form of Bins, Frequency, Value to make a histogramm list.
-def get_histogramm(lesion):
-    histogram_attrib = {}
-    histogram_data = []
-    for Histogram in lesion[1].iter('Histogram'):
-        # print (Histogram.attrib)
-        histogram_attrib = Histogram.attrib
-        # histogram_data = []
-        for bin in Histogram.iter('Bin'):
-            for i in range(int(bin.attrib['Frequency'])):
-                histogram_data.append(float(bin.attrib['Value']))
-    return histogram_data, histogram_attrib
-
-
-# parse information regarding covid assessment
-def get_covid_assessment(case):
-    covid_assessment = {}
-    label_list = ["COV-RADS Klassifikation*", "COVID-19 CT-morphologische Klassifikation", "CO-RADS Klassifikation",
-                  "Ausdehnung der Pneumonie"]
-
-    for Question in case.iter('Question'):
-        try:
-            question_label = Question.attrib['Question']
-            if question_label == "Klassifikation des Lungenbefalls":
-                answer = Question.attrib['Answer']
-                covid_assessment[question_label] = answer
-        except:
-            question_label = ""
-            answer = ""
+    Many lesions are measured on the same study, so every study is only hashed once per export. The number of cache
+    hits and misses is given by get_study_id.cache_info().
+    """
+    return encrypt(study_uid + study_date)
 
-        try:
-            question_label = Question.attrib['Label']
-            if question_label in label_list:
-                answer = Question.attrib['Answer']
-                covid_assessment[question_label] = answer
-        except:
-            question_label = ""
-            answer = ""
 
-        try:
-            question_label = Question.attrib['Text']
-            if question_label == "Nativ":
-                answer = Question.attrib['Answer']
-                covid_assessment[question_label] = answer
-        except:
-            question_label = ""
-            answer = ""
+def get_dicom_info(lesion):
+    """ Get the DICOM information of the last measurement record of a lesion, empty if it has no record. """
+    MeasurementRecord = None
+    for MeasurementRecord in lesion[1].iter('MeasurementRecord'):
+        pass
+    if MeasurementRecord is None:
+        return {}
+    attrib = MeasurementRecord.attrib
+    return dict(StudyID=get_study_id(attrib['StudyUID'], attrib['StudyDate']),
+                StudyDescription=attrib['StudyDescription'],
+                SeriesDescription=attrib['SeriesDescription'],
+                SliceThickness=attrib['SliceThickness'],
+                PixelSpacing=attrib['PixelSpacing0'])
 
-    return covid_assessment
+
+# parse information regarding covid assessment from the answer index of the case, in the order of the questions
+def get_covid_assessment(answers):
+    keys = [('Question', "Klassifikation des Lungenbefalls"), ('Text', "Nativ")] + [('Label', label) for label in
+                                                                                    covid_assessment_labels]
+    keys = sorted((key for key in keys if key in answers.attribute_answers), key=answers.attribute_positions.get)
+    return {question_label: answers.attribute_answers[attribute, question_label] for attribute, question_label in keys}
 
 
 # change to sha256 hash for anonymisation
@@ -917,7 +1020,12 @@ def get_random_characters():
 
 
 # sorry for the mess and ifs
-def getCaseLesions(case, patient_index, testing=False):
+def getCaseLesions(case, patient_index, testing=False, expand_histograms=False, percentiles=histogram_percentiles,
+                   hu_thresholds=histogram_hu_thresholds, answers=None, patient_id=None):
+    if answers is None:
+        answers = AnswerIndex(case)
+    if patient_id is None:
+        patient_id = get_patient_id(case, patient_index)
     lesion_list = []
     lesion_class = ''
 
@@ -926,27 +1034,14 @@ def getCaseLesions(case, patient_index, testing=False):
     #     'InstitutionName']
     # hash_string = encrypt(case_string)
     # hash_string = case[0].attrib['PatientID']
-    patient_id = None
-    try:
-        for p in case.iter('Patient'):
-            patient_id = p.attrib['PatientID']
-    except KeyError:
-        print(f'WARNING::Patient tag available but no PatientID. New PatientID will be generated for patient {patient_index}')
-        patient_id = f'Patient_{patient_index:03d}'
-    except Exception as e:
-        print(f'WARNING::New PatientID will be generated for patient {patient_index} due to unhandled exception when targeting PatientID: {e}')
-        patient_id = f'Patient_{patient_index:03d}'
-    if patient_id is None:
-        print(f'WARNING::No patient tag available. New PatientID will be generated for patient {patient_index}')
-        patient_id = f'Patient_{patient_index:03d}'
     try:
         DaysSinceBaseline = case[1][1].attrib['DaysSinceBaseline']
     except:
         DaysSinceBaseline = ''
 
-    covid_assessment = get_covid_assessment(case)
+    covid_assessment = get_covid_assessment(answers)
 
-    for lesion in case.iter('Lesion'):
+    for lesion in answers.lesions:
         Category = lesion.attrib['Category']
         LesionID = lesion.attrib['LesionID']
         if testing == True:
@@ -961,14 +1056,13 @@ def getCaseLesions(case, patient_index, testing=False):
                 if testing == True:
                     print(lesion_class)
 
-            for question in lesion.iter('Question'):
-                if question.attrib['Label'] == "Klassifikation der Pathologie" and question.attrib[
-                    'Assessed'] == "true":
-                    lesion_class = question.attrib['Answer']
-                    if testing == True:
-                        print(lesion_class)
+            if "Klassifikation der Pathologie" in answers.lesion_answers[lesion]:
+                lesion_class = answers.lesion_answers[lesion]["Klassifikation der Pathologie"]
+                if testing == True:
+                    print(lesion_class)
 
-            histogram_data, histogram_attrib = get_histogramm(lesion)
+            histogram_data, histogram_attrib = get_histogramm(lesion, expand=expand_histograms,
+                                                              percentiles=percentiles, hu_thresholds=hu_thresholds)
 
             case_lesion = dict(PatientID=patient_id,
                                Category=Category,
@@ -980,7 +1074,7 @@ def getCaseLesions(case, patient_index, testing=False):
             case_lesion.update(dicom_info)
             case_lesion.update(covid_assessment)
             case_lesion.update(histogram_attrib)
-            case_lesion['histogram'] = histogram_data
+            case_lesion.update(histogram_data)
             lesion_list.append(case_lesion)
 
             # run almost same script on child tree for presternal reference value
@@ -992,7 +1086,9 @@ def getCaseLesions(case, patient_index, testing=False):
                     print(lesion_class)
 
                 dicom_info = get_dicom_info(referenzmessung_presternal)
-                histogram_data, histogram_attrib = get_histogramm(referenzmessung_presternal)
+                histogram_data, histogram_attrib = get_histogramm(referenzmessung_presternal,
+                                                                  expand=expand_histograms, percentiles=percentiles,
+                                                                  hu_thresholds=hu_thresholds)
                 case_lesion = dict(PatientID=patient_id,
                                    Category=Category,
                                    Lesion_class=lesion_class,
@@ -1004,7 +1100,7 @@ def getCaseLesions(case, patient_index, testing=False):
                 case_lesion.update(dicom_info)
                 case_lesion.update(covid_assessment)
                 case_lesion.update(histogram_attrib)
-                case_lesion['histogram'] = histogram_data
+                case_lesion.update(histogram_data)
                 lesion_list.append(case_lesion)
     return lesion_list
 
@@ -1023,73 +1119,662 @@ def randomize_patient_ids(lesion_list):
     return lesion_list
 
 
-def main_digitale_stanze(cases):
-    lesion_list = []
-    exception_list = []
+def write_lesion_tables(df, out_file_stem, output_format='xlsx'):
+    """ Write the normalized lesion tables to one output per table, named by the stem and the table name. """
+    return [write_output(table, f'{out_file_stem}_{name}', output_format)
+            for name, table in normalize_lesions(df).items()]
 
-    for i, case in enumerate(cases):
-        try:
-            case_lesions = getCaseLesions(case, patient_index=i)
-            lesion_list.extend(case_lesions)
-        except Exception as e:
-            # print(f'WARNING::Could not handle case {i}/{len(cases)}: {e}')
-            exception_list.append(e)
 
-    data = pd.DataFrame.from_records(lesion_list)
+def main_digitale_stanze(cases, workers=1, expand_histograms=False, percentiles=histogram_percentiles,
+                         hu_thresholds=histogram_hu_thresholds, histogram_matrix_file=None,
+                         bin_edges=histogram_bin_edges, identity='PatientID'):
+    histogram_writer = None
+    if histogram_matrix_file is not None:
+        histogram_writer = HistogramMatrixWriter(histogram_matrix_file, bin_edges=bin_edges)
+    digitale_stanze_visitor = DigitaleStanzeVisitor(expand_histograms=expand_histograms, percentiles=percentiles,
+                                                    hu_thresholds=hu_thresholds, histogram_writer=histogram_writer)
+    extract_cases(cases, [digitale_stanze_visitor], workers=workers, identity=identity)
+
+    data = pd.DataFrame.from_records(digitale_stanze_visitor.lesion_list)
+    if histogram_writer is not None:
+        histogram_writer.close()
+        write_histogram_metadata(data, f'{os.path.splitext(histogram_matrix_file)[0]}_metadata.csv')
     return data
 
 
+class CaseContext:
+    """ A case during the shared traversal, indexes of the case are built on first use and shared by all visitors.
+
+    Args:
+        case: Current case (XML element)
+        index: Index of the case, used to generate a new patient ID if the case does not provide one.
+        identity: Name of the strategy resolving the patient ID, see patient_identities.
+
+    """
+
+    def __init__(self, case, index, identity='PatientID'):
+        self.case = case
+        self.index = index
+        self.identity = identity
+        self._patient_id = None
+        self._answers = None
+        self._study_dates = None
+
+    @property
+    def patient_id(self):
+        """ Patient ID of the case, resolved once by the selected strategy. """
+        if self._patient_id is None:
+            self._patient_id = patient_identities[self.identity](self.case, self.index)
+        return self._patient_id
+
+    @property
+    def has_generated_patient_id(self):
+        """ Whether a patient ID generated from the index of the case has been used, see get_generated_patient_id. """
+        generated_id = get_generated_patient_id(self.index)
+        return self._patient_id in (generated_id, encrypt_id(generated_id))
+
+    @property
+    def answers(self):
+        """ AnswerIndex of the case. """
+        if self._answers is None:
+            self._answers = AnswerIndex(self.case)
+        return self._answers
+
+    @property
+    def study_dates(self):
+        """ Mapping of assessment ID to CT study date within the case, see get_study_dates. """
+        if self._study_dates is None:
+            self._study_dates = get_study_dates(self.answers)
+        return self._study_dates
+
+
+class CaseVisitor:
+    """ Base class for a project that is extracted during the shared traversal over all cases.
+
+    The traversal calls visit_case with the CaseContext once for every case and afterwards visit_task once for every
+    task (template) of that case, so each case and task subtree is only walked once, regardless of the number of
+    projects. For parallel extraction, every worker process fills empty copies created by spawn, which are merged back
+    in case order.
+    """
+
+    def visit_case(self, context):
+        pass
+
+    def visit_task(self, task, template_name):
+        pass
+
+    def spawn(self):
+        """ Create an empty visitor with the same configuration. """
+        return type(self)()
+
+    def merge(self, other):
+        """ Add the information collected by another visitor of the same type. """
+        pass
+
+    def cache_key(self):
+        """ Identify the configuration of the visitor, cached information is only reused for the same key. """
+        return type(self).__name__
+
+    def dump(self):
+        """ Return the collected information as plain data, e.g. to cache the information of a single case. """
+        return None
+
+    def load(self, data):
+        """ Add information previously returned by dump. """
+        pass
+
+
+# Columns added to the CT rows, see compile_extraction_plan
+ct_template_columns = {'CT': ['CT//AssessmentID', 'CT//StudyDate']}
+
+
+class TemplateVisitor(CaseVisitor):
+    """ Collects the template information of a project defined by its required parameters (risk model, COV-RADS). """
+
+    def __init__(self, required_parameters, additional_columns=None):
+        if isinstance(required_parameters, str):
+            with open(required_parameters, encoding='utf-8') as json_file:
+                required_parameters = json.load(json_file)
+        self.params = required_parameters
+        self.additional_columns = additional_columns
+        self.accumulator = create_empty_dataframe(params=required_parameters, additional_columns=additional_columns)
+        self.plan = compile_extraction_plan(required_parameters, self.accumulator, template_columns=ct_template_columns)
+        self.patient_id = None
+        self.case_id = None
+        self.task_positions = {}
+        self.task_answers = {}
+        self.study_dates = {}
+
+    def visit_case(self, context):
+        self.patient_id = context.patient_id
+        self.case_id = context.case.attrib.get('CaseID')
+        self.task_positions = {task: j for j, task in enumerate(context.answers.tasks)}
+        self.task_answers = context.answers.task_answers
+        if 'CT' in self.plan:
+            self.study_dates = context.study_dates
+
+    def visit_task(self, task, template_name):
+        template_plan = self.plan.get(template_name)
+        if template_plan is None:
+            return
+        try:
+            values = self.accumulator.new_row()
+            values[self.accumulator.column_index['PatientID']] = self.patient_id
+            values[self.accumulator.column_index['Template']] = template_name
+            assessment_id = get_assessment_id(task, self.case_id, self.task_positions[task])
+            values[self.accumulator.column_index['AssessmentID']] = assessment_id
+            if template_name == 'CT':
+                assessment_id = task.attrib['AssessmentID']
+                values[self.accumulator.column_index['CT//AssessmentID']] = assessment_id
+                values[self.accumulator.column_index['CT//StudyDate']] = self.study_dates.get(assessment_id, np.nan)
+            self.accumulator.append_values(get_task_information(self.task_answers[task], template_plan, values))
+        except KeyError:
+            print(f'ERROR::KeyError with key {template_name}')
+
+    def spawn(self):
+        return TemplateVisitor(self.params, additional_columns=self.additional_columns)
+
+    def merge(self, other):
+        self.accumulator.extend(other.accumulator)
+
+    def cache_key(self):
+        plan = json.dumps([self.accumulator.columns, self.plan], ensure_ascii=False)
+        return f'{type(self).__name__}:{hashlib.sha256(plan.encode()).hexdigest()}'
+
+    def dump(self):
+        return self.accumulator.columns, self.accumulator.buffers, self.accumulator.n_rows
+
+    def load(self, data):
+        self.accumulator.extend_buffers(*data)
+
+
+class DigitaleStanzeVisitor(CaseVisitor):
+    """ Collects the lesions and histograms of the Digitale Stanze project. """
+
+    def __init__(self, expand_histograms=False, percentiles=histogram_percentiles,
+                 hu_thresholds=histogram_hu_thresholds, histogram_writer=None):
+        self.expand_histograms = expand_histograms
+        self.percentiles = tuple(percentiles)
+        self.hu_thresholds = tuple(hu_thresholds)
+        # Optional HistogramMatrixWriter, it stays in this process and is not passed on to spawned visitors
+        self.histogram_writer = histogram_writer
+        self.lesion_list = []
+
+    def add_lesions(self, lesions):
+        self.lesion_list.extend(lesions)
+        if self.histogram_writer is not None:
+            self.histogram_writer.add(lesions)
+
+    def visit_case(self, context):
+        case_lesions = getCaseLesions(context.case, patient_index=context.index,
+                                      expand_histograms=self.expand_histograms, percentiles=self.percentiles,
+                                      hu_thresholds=self.hu_thresholds, answers=context.answers,
+                                      patient_id=context.patient_id)
+        self.add_lesions(case_lesions)
+
+    def spawn(self):
+        return DigitaleStanzeVisitor(expand_histograms=self.expand_histograms, percentiles=self.percentiles,
+                                     hu_thresholds=self.hu_thresholds)
+
+    def __getstate__(self):
+        # The histogram writer is not sent to worker processes
+        state = self.__dict__.copy()
+        state['histogram_writer'] = None
+        return state
+
+    def cache_key(self):
+        return (f'{type(self).__name__}:{"expanded" if self.expand_histograms else "compact"}:'
+                f'{self.percentiles}:{self.hu_thresholds}')
+
+    def merge(self, other):
+        self.add_lesions(other.lesion_list)
+
+    def dump(self):
+        return self.lesion_list
+
+    def load(self, data):
+        self.add_lesions(data)
+
+
+def traverse_cases(cases, visitors, indexes=None, identity='PatientID', generated_cases=None):
+    """ Walk over all cases once and let every visitor extract its information.
+
+    Errors raised by a visitor are collected per case, the visitor then skips the remaining tasks of that case while
+    all other visitors continue.
+
+    Args:
+        cases: Iterable of cases (XML elements), e.g. from iter_cases.
+        visitors: List of CaseVisitor objects, one for each project.
+        indexes: Index of each case within the XML file, defaults to the position in cases.
+        identity: Name of the strategy resolving the patient ID of each case, see patient_identities.
+        generated_cases: Set collecting the indexes of the cases with a generated patient ID.
+
+    Returns:
+        list: List of (case index, visitor name, error message) tuples.
+
+    """
+    errors = []
+    for i, case in (enumerate(cases) if indexes is None else zip(indexes, cases)):
+        if i % 100 == 0:
+            print(f'INFO::Currently handling case: {i}')
+        context = CaseContext(case, i, identity=identity)
+        case_visitors = []
+        for visitor in visitors:
+            try:
+                visitor.visit_case(context)
+                case_visitors.append(visitor)
+            except Exception as e:
+                errors.append((i, type(visitor).__name__, repr(e)))
+        for task in (context.answers.tasks if case_visitors else ()):
+            for visitor in list(case_visitors):
+                try:
+                    visitor.visit_task(task, clean_template_name(task.attrib['Header']))
+                except Exception as e:
+                    errors.append((i, type(visitor).__name__, repr(e)))
+                    case_visitors.remove(visitor)
+        if generated_cases is not None and context.has_generated_patient_id:
+            generated_cases.add(i)
+    return errors
+
+
+worker_visitors = []
+worker_identity = ['PatientID']
+
+
+def init_worker(visitors, identity='PatientID'):
+    """ Store the (empty) visitors and the patient identity strategy in a worker process for every batch. """
+    worker_visitors[:] = visitors
+    worker_identity[:] = [identity]
+
+
+def extract_case_batch(batch):
+    """ Extract a batch of serialized cases in a worker process.
+
+    Args:
+        batch: Tuple of the case indexes and a list of serialized cases.
+
+    Returns:
+        tuple: List of visitors filled with the information of the batch and list of errors, see traverse_cases.
+
+    """
+    indexes, case_strings = batch
+    visitors = [visitor.spawn() for visitor in worker_visitors]
+    errors = traverse_cases((et.fromstring(case_string) for case_string in case_strings), visitors, indexes=indexes,
+                            identity=worker_identity[0])
+    return visitors, errors
+
+
+def extract_case_range_batch(batch):
+    """ Read a batch of cases by their byte ranges and extract them in a worker process.
+
+    Args:
+        batch: Tuple of the case indexes, the path to the XML file and a list of (offset, length) ranges.
+
+    Returns:
+        tuple: See extract_case_batch.
+
+    """
+    indexes, input_file, ranges = batch
+    return extract_case_batch((indexes, read_case_ranges(input_file, ranges)))
+
+
+def extract_single_cases(cases, indexes, visitors, identity='PatientID'):
+    """ Extract every case with its own set of empty visitors, so that the information can be cached per case.
+
+    Args:
+        cases: Iterable of cases (XML elements).
+        indexes: Index of each case within the XML file.
+        visitors: List of CaseVisitor objects, they serve as templates and are not filled.
+        identity: Name of the strategy resolving the patient ID of each case, see patient_identities.
+
+    Returns:
+        list: For each case a tuple of its index, the dumped information of each visitor, the list of errors (see
+              traverse_cases) and whether the case has a generated patient ID.
+
+    """
+    results = []
+    for i, case in zip(indexes, cases):
+        case_visitors = [visitor.spawn() for visitor in visitors]
+        generated_cases = set()
+        errors = traverse_cases([case], case_visitors, indexes=[i], identity=identity, generated_cases=generated_cases)
+        results.append((i, [visitor.dump() for visitor in case_visitors], errors, i in generated_cases))
+    return results
+
+
+def extract_case_range_results(batch):
+    """ Read a batch of cases by their byte ranges and extract every case separately in a worker process.
+
+    Args:
+        batch: Tuple of the case indexes, the path to the XML file and a list of (offset, length) ranges.
+
+    Returns:
+        list: See extract_single_cases.
+
+    """
+    indexes, input_file, ranges = batch
+    case_strings = read_case_ranges(input_file, ranges)
+    return extract_single_cases((et.fromstring(case_string) for case_string in case_strings), indexes,
+                                worker_visitors, identity=worker_identity[0])
+
+
+def iter_index_batches(input_file, entries, batch_size=50):
+    """ Group the byte ranges of indexed cases into batches, the worker processes read the cases themselves. """
+    for i in range(0, len(entries), batch_size):
+        batch = entries[i:i + batch_size]
+        yield [entry['index'] for entry in batch], input_file, [(entry['offset'], entry['length']) for entry in batch]
+
+
+def merge_case_batches(visitors, results):
+    """ Merge the results of the worker processes into the visitors and return the collected errors. """
+    errors = []
+    for partial_visitors, partial_errors in results:
+        for visitor, partial_visitor in zip(visitors, partial_visitors):
+            visitor.merge(partial_visitor)
+        errors.extend(partial_errors)
+    return errors
+
+
+def report_case_errors(errors):
+    for i, visitor_name, error in errors:
+        print(f'WARNING::{visitor_name} could not handle case {i}: {error}')
+
+
+def extract_cases(cases, visitors, workers=1, identity='PatientID'):
+    """ Extract all cases with the given visitors, either in this process or distributed over a process pool.
+
+    Both modes produce the same rows in the same order. Errors of single cases are reported once the extraction is
+    finished.
+
+    Args:
+        cases: Iterable of cases (XML elements), e.g. from iter_cases.
+        visitors: List of CaseVisitor objects, one for each project.
+        workers: Number of worker processes, 1 extracts all cases in this process.
+        identity: Name of the strategy resolving the patient ID of each case, see patient_identities.
+
+    Returns:
+        list: List of (case index, visitor name, error message) tuples.
+
+    """
+    if workers > 1:
+        print(f'INFO::Distributing cases over {workers} worker processes')
+        batches = iter_case_batches(cases)
+        results = map_case_batches(batches, workers, extract_case_batch, init_worker, (visitors, identity))
+        errors = merge_case_batches(visitors, results)
+    else:
+        errors = traverse_cases(cases, visitors, identity=identity)
+    report_case_errors(errors)
+    return errors
+
+
+def extract_indexed_cases(input_file, entries, visitors, workers=1, identity='PatientID'):
+    """ Extract the given cases of an XML file by their byte ranges from the case index.
+
+    Args:
+        input_file: Path to the XML file
+        entries: Index entries of the cases, see select_cases.
+        visitors: List of CaseVisitor objects, one for each project.
+        workers: Number of worker processes, 1 extracts all cases in this process. The worker processes read their
+                 cases from the file themselves, so the file is not scanned again.
+        identity: Name of the strategy resolving the patient ID of each case, see patient_identities.
+
+    Returns:
+        list: List of (case index, visitor name, error message) tuples.
+
+    """
+    if workers > 1:
+        print(f'INFO::Distributing cases over {workers} worker processes')
+        batches = iter_index_batches(input_file, entries)
+        results = map_case_batches(batches, workers, extract_case_range_batch, init_worker, (visitors, identity))
+        errors = merge_case_batches(visitors, results)
+    else:
+        errors = traverse_cases(iter_indexed_cases(input_file, entries), visitors,
+                                indexes=[entry['index'] for entry in entries], identity=identity)
+    report_case_errors(errors)
+    return errors
+
+
+case_cache_version = 3
+
+
+class CaseCache:
+    """ Persistent cache of the extracted information of single cases, stored in a SQLite database.
+
+    Each entry is keyed by the hash of the raw bytes of a case and the cache key of a visitor, which covers the
+    compiled required parameters. Cases that did not change since a previous export are therefore not extracted again.
+    """
+
+    def __init__(self, cache_file):
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS case_cache '
+                                '(case_hash TEXT, visitor_key TEXT, data BLOB, PRIMARY KEY (case_hash, visitor_key))')
+
+    def get(self, case_hashes, visitor_keys, chunk_size=500):
+        """ Get the cached information of the given cases as dictionary mapping (case hash, visitor key) -> data. """
+        cached = {}
+        visitor_keys = set(visitor_keys)
+        for i in range(0, len(case_hashes), chunk_size):
+            chunk = case_hashes[i:i + chunk_size]
+            rows = self.connection.execute(f'SELECT case_hash, visitor_key, data FROM case_cache '
+                                           f'WHERE case_hash IN ({", ".join("?" * len(chunk))})', chunk)
+            for case_hash, visitor_key, data in rows:
+                if visitor_key in visitor_keys:
+                    cached[case_hash, visitor_key] = data
+        return cached
+
+    def put(self, entries):
+        """ Store a list of (case hash, visitor key, data) entries. """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO case_cache VALUES (?, ?, ?)', entries)
+
+    def close(self):
+        self.connection.close()
+
+
+def get_case_hash(case_bytes):
+    """ Hash the raw bytes of a case. """
+    return hashlib.sha256(case_bytes).hexdigest()
+
+
+def extract_cached_cases(input_file, entries, visitors, cache, workers=1, identity='PatientID'):
+    """ Extract the given cases of an XML file, reusing the information of unchanged cases from the cache.
+
+    Only new or changed cases are parsed and extracted, their information is added to the cache afterwards. Cases
+    with errors are not cached, so they are extracted (and reported) again next time. Neither are cases with a patient
+    ID generated from their position within the file, as the position may change. The information of all cases is
+    merged in case order, so the result is the same as without cache.
+
+    Args:
+        input_file: Path to the XML file
+        entries: Index entries of the cases, see select_cases.
+        visitors: List of CaseVisitor objects, one for each project.
+        cache: CaseCache object.
+        workers: Number of worker processes for the extraction of new or changed cases.
+        identity: Name of the strategy resolving the patient ID of each case, see patient_identities. It is part of
+                  the cache key, as the cached rows contain the resolved patient IDs.
+
+    Returns:
+        list: List of (case index, visitor name, error message) tuples.
+
+    """
+    visitor_keys = [f'{visitor.cache_key()}:{identity}:{case_cache_version}' for visitor in visitors]
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        case_hashes = [get_case_hash(mm[entry['offset']:entry['offset'] + entry['length']]) for entry in entries]
+    cached = cache.get(case_hashes, visitor_keys)
+    missing_entries = [entry for entry, case_hash in zip(entries, case_hashes)
+                       if any((case_hash, visitor_key) not in cached for visitor_key in visitor_keys)]
+    print(f'INFO::Reusing {len(entries) - len(missing_entries)} cached cases, extracting {len(missing_entries)} '
+          f'new or changed cases')
+
+    if workers > 1 and missing_entries:
+        print(f'INFO::Distributing cases over {workers} worker processes')
+        batches = iter_index_batches(input_file, missing_entries)
+        results = [result for batch_results in map_case_batches(batches, workers, extract_case_range_results,
+                                                                 init_worker, (visitors, identity))
+                   for result in batch_results]
+    else:
+        results = extract_single_cases(iter_indexed_cases(input_file, missing_entries),
+                                       [entry['index'] for entry in missing_entries], visitors, identity=identity)
+    results = {i: (case_data, case_errors, generated) for i, case_data, case_errors, generated in results}
+
+    errors = []
+    new_entries = []
+    for entry, case_hash in zip(entries, case_hashes):
+        if entry['index'] in results:
+            case_data, case_errors, generated = results[entry['index']]
+            errors.extend(case_errors)
+            failed_visitors = {visitor_name for _, visitor_name, _ in case_errors}
+            for visitor, visitor_key, data in zip(visitors, visitor_keys, case_data):
+                visitor.load(data)
+                if not generated and type(visitor).__name__ not in failed_visitors:
+                    new_entries.append((case_hash, visitor_key, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        else:
+            for visitor, visitor_key in zip(visitors, visitor_keys):
+                visitor.load(pickle.loads(cached[case_hash, visitor_key]))
+    cache.put(new_entries)
+    report_case_errors(errors)
+    return errors
+
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for the case extraction')
+    parser.add_argument('--output-format', choices=get_output_formats(), default='xlsx',
+                        help=f'Format of the output files, sqlite tables are written to {sqlite_database_name}, '
+                             'parquet and feather require pyarrow')
+    parser.add_argument('--build-index', action='store_true', help='Only build the case index of the XML file')
+    parser.add_argument('--use-index', action='store_true', help='Read the cases by their byte ranges from the case '
+                                                                  'index, which is built if necessary')
+    parser.add_argument('--cases', nargs='+', help='Only extract the given CaseIDs (uses the case index)')
+    parser.add_argument('--patients', nargs='+', help='Only extract the cases of the given PatientIDs (uses the case '
+                                                      'index)')
+    parser.add_argument('--expand-histograms', action='store_true', help='Write each lesion histogram as list of '
+                        'all voxel values instead of bin values and frequencies')
+    parser.add_argument('--percentiles', nargs='*', type=float, default=histogram_percentiles,
+                        help='Percentiles of the lesion histograms')
+    parser.add_argument('--hu-thresholds', nargs='*', type=float, default=histogram_hu_thresholds,
+                        help='HU thresholds for the fraction of lesion voxels below')
+    parser.add_argument('--histogram-matrix', action='store_true', help='Also write the lesion histograms as '
+                        'float32 matrix (lesions x HU bins) to a .npy file with a row-aligned metadata table')
+    parser.add_argument('--bin-edges', nargs=3, type=float, default=(-1024.5, 1024.5, 1.0),
+                        metavar=('START', 'STOP', 'WIDTH'), help='HU bin edges of the histogram matrix')
+    parser.add_argument('--cache', nargs='?', const='case_cache.sqlite', help='Reuse the extracted information of '
+                        'unchanged cases from a cache file, default case_cache.sqlite (uses the case index)')
+    parser.add_argument('--faulty-date-threshold', nargs='?', type=float, const=faulty_date_threshold,
+                        help='Report date values more than this number of days after the baseline date to '
+                             f'extraction_info.txt, default {faulty_date_threshold}')
+    parser.add_argument('--pseudonym-vault', nargs='?', const='pseudonym_vault.sqlite',
+                        help='Keep the pseudonyms of the PatientIDs stable across exports by storing them in a vault '
+                             'file, default pseudonym_vault.sqlite (keep this file private)')
+    parser.add_argument('--patient-identity', choices=list(patient_identities), default='PatientID',
+                        help='Resolve the patient of each case by its PatientID or by a SHA256 hash of CaseID, '
+                             'LastName, PatientID and InstitutionName')
+    parser.add_argument('--lesion-tables', action='store_true', help='Write the Digitale Stanze lesions as separate '
+                        'case, study, lesion and histogram tables joined by keys instead of one flat table')
+    cli_args = parser.parse_args()
+
     print('START::XML extraction started. This might take up to a few minutes...')
 
-    args = {'anonymization': 'UUID4', 'additional_columns': ['CT//AssessmentID']}
+    args = {'anonymization': 'UUID4', 'additional_columns': ['CT//AssessmentID'], 'workers': cli_args.workers,
+            'identity': cli_args.patient_identity}
     print('INFO::Given arguments:')
     for k, v in args.items():
         print('\t', k, '->', v)
 
     script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
     print(f'INFO::Current working directory: {script_dir}')
-    xml_files = [file for file in os.listdir(script_dir) if '.xml' in file]
+    xml_files = [file for file in os.listdir(script_dir) if file.lower().endswith('.xml')]
 
-    if len(xml_files) > 0:
+    if len(xml_files) > 0 and cli_args.build_index:
+        print(f'INFO::Building case index of file {xml_files[0]}')
+        build_case_index(xml_files[0])
+    elif len(xml_files) > 0:
         print(f'INFO::Processing file {xml_files[0]}')
 
         start = datetime.now()
-        print('INFO::Extracting tree and root objects from XML file')
-        tree = et.parse(xml_files[0])
-        root = tree.getroot()
 
-        all_cases = get_cases(root)
+        risk_model_visitor = TemplateVisitor(required_parameters_risk_model,
+                                             additional_columns=args['additional_columns'])
+        cov_rads_visitor = TemplateVisitor(required_parameters_cov_rads, additional_columns=args['additional_columns'])
+        histogram_writer = None
+        if cli_args.histogram_matrix:
+            start_edge, stop_edge, bin_width = cli_args.bin_edges
+            histogram_writer = HistogramMatrixWriter(os.path.join(script_dir, 'lesion_histogram_matrix_V5.npy'),
+                                                     bin_edges=np.arange(start_edge, stop_edge + bin_width / 2,
+                                                                         bin_width))
+        digitale_stanze_visitor = DigitaleStanzeVisitor(expand_histograms=cli_args.expand_histograms,
+                                                        percentiles=cli_args.percentiles,
+                                                        hu_thresholds=cli_args.hu_thresholds,
+                                                        histogram_writer=histogram_writer)
+
+        visitors = [risk_model_visitor, cov_rads_visitor, digitale_stanze_visitor]
+
+        print(f'INFO::Extracting case information for all projects')
+        if cli_args.use_index or cli_args.cases or cli_args.patients or cli_args.cache:
+            case_entries = select_cases(load_case_index(xml_files[0]), case_ids=cli_args.cases,
+                                        patient_ids=cli_args.patients)
+            print(f'INFO::Extracting {len(case_entries)} cases using the case index')
+            if cli_args.cache:
+                case_cache = CaseCache(os.path.join(script_dir, cli_args.cache))
+                extract_cached_cases(xml_files[0], case_entries, visitors, case_cache, workers=args['workers'],
+                                     identity=args['identity'])
+                case_cache.close()
+            else:
+                extract_indexed_cases(xml_files[0], case_entries, visitors, workers=args['workers'],
+                                      identity=args['identity'])
+        else:
+            extract_cases(iter_cases(xml_files[0]), visitors, workers=args['workers'], identity=args['identity'])
+        info = 'all' if not (cli_args.cases or cli_args.patients) else 'selected'
 
         print(f'INFO::Processing risk model data')
-        data_risk_model, info = main(required_parameters=required_parameters_risk_model,
-                                     date_cols=date_columns_risk_model, all_cases=all_cases, **args)
+        data_risk_model = process_template_data(risk_model_visitor.accumulator.to_dataframe(), date_columns_risk_model)
         print(f'INFO::Processing cov rads validation data')
-        data_cov_rads, info = main(required_parameters=required_parameters_cov_rads,
-                                   date_cols=date_columns_cov_rads, all_cases=all_cases, **args)
+        data_cov_rads = process_template_data(cov_rads_visitor.accumulator.to_dataframe(), date_columns_cov_rads)
+
+        if cli_args.faulty_date_threshold is not None:
+            print(f'INFO::Report date values more than {cli_args.faulty_date_threshold:g} days after the baseline date')
+            threshold = cli_args.faulty_date_threshold
+            faulty_dates = pd.concat([get_faulty_dates(data_risk_model, date_columns_risk_model, threshold=threshold),
+                                      get_faulty_dates(data_cov_rads, date_columns_cov_rads, threshold=threshold)])
+            faulty_logs(faulty_dates.drop_duplicates(ignore_index=True), threshold=threshold,
+                        info_file=os.path.join(script_dir, 'extraction_info.txt'))
 
         # Anonymize data
         print(f'INFO::Anonymize data')
-        replacements = {id_: uuid.uuid4() for id_ in data_risk_model['PatientID'].unique()}
+        vault = None
+        if cli_args.pseudonym_vault:
+            vault = PseudonymVault(os.path.join(script_dir, cli_args.pseudonym_vault))
+        replacements = get_replacements(pd.unique(pd.concat([data_risk_model['PatientID'],
+                                                             data_cov_rads['PatientID']])), vault)
         data_risk_model = anonymize(data_risk_model, uids=replacements)
         data_cov_rads = anonymize(data_cov_rads, uids=replacements)
 
-        print('INFO::Save excel files')
-        out_file_risk_model = os.path.join(script_dir, f'{info}_raw_data_risk-model_V5.xlsx')
-        out_file_cov_rads = os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation_V5.xlsx')
-        data_risk_model.to_excel(out_file_risk_model, index=False)
-        data_cov_rads.to_excel(out_file_cov_rads, index=False)
+        print(f'INFO::Save {cli_args.output_format} files')
+        write_output(data_risk_model, os.path.join(script_dir, f'{info}_raw_data_risk-model_V5'),
+                     cli_args.output_format)
+        write_output(data_cov_rads, os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation_V5'),
+                     cli_args.output_format)
 
         print(f'INFO::Processing digitale stanze data')
-        data_digitale_stanze = main_digitale_stanze(all_cases)
+        data_digitale_stanze = pd.DataFrame.from_records(digitale_stanze_visitor.lesion_list)
         # Update replacements
-        for id_ in data_digitale_stanze['PatientID'].unique():
-            if id_ not in replacements.keys():
-                print(f'INFO::Add anonymized id for patient {id_}')
-                replacements[id_] = uuid.uuid4()
+        new_ids = [id_ for id_ in data_digitale_stanze['PatientID'].unique() if id_ not in replacements]
+        for id_ in new_ids:
+            print(f'INFO::Add anonymized id for patient {id_}')
+        replacements.update(get_replacements(new_ids, vault))
+        if vault is not None:
+            vault.close()
         data_digitale_stanze = anonymize(data_digitale_stanze, uids=replacements)
-        out_file_digitale_stanze = os.path.join(script_dir, f'lesion_histogram_list_V5.xlsx')
-        data_digitale_stanze.to_excel(out_file_digitale_stanze, index=False)
+        if histogram_writer is not None:
+            histogram_writer.close()
+            write_histogram_metadata(data_digitale_stanze,
+                                     os.path.join(script_dir, 'lesion_histogram_matrix_V5_metadata.csv'))
+        if cli_args.lesion_tables:
+            write_lesion_tables(data_digitale_stanze, os.path.join(script_dir, 'lesion_histogram_list_V5'),
+                                cli_args.output_format)
+        else:
+            write_output(data_digitale_stanze, os.path.join(script_dir, 'lesion_histogram_list_V5'),
+                         cli_args.output_format)
 
         print('DONE::XML extraction finished')
 
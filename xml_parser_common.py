@@ -0,0 +1,982 @@
+""" Helpers shared by the XML parser scripts: streaming the cases, extracting them in parallel, accumulating the
+template rows, converting the date and free text columns, splitting the lesions into tables and writing the outputs.
+
+The scripts import these helpers instead of keeping their own copies, so that fixes apply to all of them at once.
+"""
+import csv, hashlib, json, multiprocessing, os, re, sqlite3, struct, uuid
+import pandas as pd
+import numpy as np
+from datetime import date, datetime, timedelta
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+import xml.etree.ElementTree as et
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+
+
+def iter_cases(input_file):
+    """ Stream all cases of an XML file one at a time.
+
+    The file is parsed incrementally, so only the case that is currently handled is kept in memory. Once the caller
+    requests the next case, the previous one is cleared and detached from the tree. Callers must therefore extract
+    everything they need from a case before moving on to the next one.
+
+    Args:
+        input_file: Path to the XML file
+
+    Yields:
+        xml.etree.ElementTree.Element: Next case of the XML file.
+    """
+    path = []
+    for event, elem in et.iterparse(input_file, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            continue
+        path.pop()
+        if elem.tag != 'Case':
+            continue
+        ancestors = [e.tag for e in path]
+        if 'Trial' in ancestors and 'TrialArm' in ancestors[ancestors.index('Trial'):]:
+            yield elem
+        # Free the subtree of the handled case, including the reference kept by its parent
+        elem.clear()
+        if path:
+            path[-1].remove(elem)
+
+
+def iter_case_batches(cases, batch_size=50):
+    """ Serialize the streamed cases and group them into batches for the worker processes. """
+    indexes = []
+    batch = []
+    for i, case in enumerate(cases):
+        indexes.append(i)
+        batch.append(et.tostring(case))
+        if len(batch) == batch_size:
+            yield indexes, batch
+            indexes = []
+            batch = []
+    if batch:
+        yield indexes, batch
+
+
+def map_case_batches(batches, workers, function, initializer=None, initargs=(), args=()):
+    """ Extract batches of cases in a process pool and yield the results in the original order of the cases.
+
+    At most two batches per worker are in flight at the same time, so memory usage stays bounded while the main
+    process is still streaming the XML file.
+
+    Args:
+        batches: Iterable of batches, see iter_case_batches.
+        workers: Number of worker processes.
+        function: Function extracting a single batch in a worker process, called with the batch and args.
+        initializer: Function called with initargs once in every worker process, e.g. to store the extraction settings.
+        initargs: Arguments for the initializer.
+        args: Further arguments for function.
+
+    Yields:
+        Result of function for each batch.
+
+    """
+    pending = deque()
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        for batch in batches:
+            pending.append(pool.apply_async(function, (batch, *args)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+class ColumnAccumulator:
+    """ Collects rows column by column and builds the dataframe once at the end.
+
+    Each column gets a fixed index when the accumulator is set up from the schema, and every row is written into
+    per-column value buffers. Columns that are not part of the schema are added on first use and filled up with NaN
+    for all previous rows, as DataFrame.append did.
+    """
+
+    def __init__(self, columns):
+        self.columns = []
+        self.column_index = {}
+        self.buffers = []
+        self.n_rows = 0
+        for column in columns:
+            self.add_column(column)
+
+    def __len__(self):
+        return self.n_rows
+
+    def add_column(self, column):
+        """ Add a new column and return its index. """
+        index = len(self.columns)
+        self.column_index[column] = index
+        self.columns.append(column)
+        self.buffers.append([np.nan] * self.n_rows)
+        return index
+
+    def new_row(self):
+        """ Create an empty row with one NaN value for each column. """
+        return [np.nan] * len(self.columns)
+
+    def append(self, row):
+        """ Append a row given as dictionary mapping column names to values. Missing columns are set to NaN. """
+        values = self.new_row()
+        for column, value in row.items():
+            index = self.column_index.get(column)
+            if index is None:
+                index = self.add_column(column)
+                values.append(np.nan)
+            values[index] = value
+        self.append_values(values)
+
+    def append_values(self, values):
+        """ Append a row given as list with one value for each column, e.g. created by new_row. """
+        for buffer, value in zip(self.buffers, values):
+            buffer.append(value)
+        self.n_rows += 1
+
+    def extend(self, other):
+        """ Append all rows of another accumulator, e.g. the partial result of a worker process. """
+        self.extend_buffers(other.columns, other.buffers, other.n_rows)
+
+    def extend_buffers(self, columns, buffers, n_rows):
+        """ Append rows given as one value buffer for each of the given columns. """
+        column_index = {column: index for index, column in enumerate(columns)}
+        for column in columns:
+            if column not in self.column_index:
+                self.add_column(column)
+        for column, buffer in zip(self.columns, self.buffers):
+            index = column_index.get(column)
+            if index is None:
+                buffer.extend([np.nan] * n_rows)
+            else:
+                # Missing values lose their identity with np.nan when sent from a worker process or loaded from the
+                # cache, but the post-processing relies on checks like `np.nan in values`
+                buffer.extend(np.nan if value != value else value for value in buffers[index])
+        self.n_rows += n_rows
+
+    def to_dataframe(self):
+        """ Build the dataframe from all collected rows. """
+        data = {column: pd.Series(buffer, dtype=object) for column, buffer in zip(self.columns, self.buffers)}
+        return pd.DataFrame(data, columns=self.columns)
+
+
+def compile_extraction_plan(params, accumulator, template_columns=None):
+    """ Compile the required parameters into a lookup table of column indexes.
+
+    The plan is built once and maps template -> group -> question -> index of the column in the accumulator, so that
+    every question only costs a single dictionary lookup during extraction.
+
+    Args:
+        params: Dictionary containing the names of the required parameters.
+        accumulator: ColumnAccumulator containing one column for each required parameter.
+        template_columns: Dictionary of additional columns for each template, e.g. the assessment ID and the study date
+                          of CT templates. They are added to the accumulator if the template is required.
+
+    Returns:
+        dict: Nested dictionary with the column index of each required question.
+
+    """
+    for template, columns in (template_columns or {}).items():
+        if template in params:
+            for column in columns:
+                if column not in accumulator.column_index:
+                    accumulator.add_column(column)
+    return {template: {group: {question: accumulator.column_index[f'{template}//{group}::{question}']
+                               for question in params[template][group]}
+                       for group in params[template]}
+            for template in params}
+
+
+def get_assessment_id(task, case_id, position):
+    """ Return the AssessmentID of a task, tasks without one are identified by their case and position instead.
+
+    The generated ID keeps the rows (PatientID, Template, AssessmentID) of all tasks of a patient apart, even of
+    identical tasks. It does not depend on the answers of the task, so repeated exports replace the same row.
+
+    Args:
+        task: Task (XML element)
+        case_id: CaseID of the case containing the task.
+        position: Position of the task within the case.
+
+    Returns:
+        str: AssessmentID of the task, e.g. 'Task_3f1c9a0b2d4e6f87' if the task does not have one.
+
+    """
+    assessment_id = task.attrib.get('AssessmentID')
+    if assessment_id:
+        return assessment_id
+    return f'Task_{hashlib.sha256(f"{case_id}:{position}".encode()).hexdigest()[:16]}'
+
+
+re_date = re.compile(r'\d{4}[.-]\d{1,2}[.-]\d{1,2}')
+re_date_german = re.compile(r'\d{2}.\d{2}.\d{4}')
+re_date_iso = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+
+
+@lru_cache(maxsize=65536)
+def parse_date(s, regex=re_date, str_pattern='%Y-%m-%d', return_string=False):
+    """ Extract the first date of a string, use parse_dates for the values of a column.
+
+    The same dates occur many times within an export, so the results are cached by the raw string. The number of cache
+    hits and misses is given by parse_date.cache_info().
+
+    Args:
+        s: String that might contain a date.
+        regex: Pattern of the date, by default '%Y-%m-%d' with '-' or '.' as separator. If no such date can be found,
+               the date is searched with format '%d.%m.%Y'.
+        str_pattern: Format of dates found by regex, '%Y-%d-%m' is used instead if the month is larger than 12.
+        return_string: Return the found date string instead of the date.
+
+    Returns:
+        datetime.date: Extracted date (or date string), np.nan if no (valid) date is found.
+
+    """
+    try:
+        # Fast path for plain ISO dates
+        if not return_string and regex is re_date and str_pattern == '%Y-%m-%d' and re_date_iso.fullmatch(s):
+            year, month, day = int(s[:4]), int(s[5:7]), int(s[8:10])
+            return date(year, day, month) if month > 12 else date(year, month, day)
+        match = re.compile(regex).search(s)
+        # Handle date format '%d.%m.%Y' if '%Y-%m-%d' (or similar ones) cannot be found
+        if match is None:
+            match = re_date_german.search(s)
+            if match is None:
+                return np.nan
+            else:
+                date_str = match.group()
+                return date_str if return_string else datetime.strptime(date_str, '%d.%m.%Y').date()
+        date_str = match.group()
+        # Replace separator between year, month and date with '-'
+        date_str = date_str.replace('.', '-')
+        # If month digits are larger than 12, then we assume date pattern to be '%Y-%d-%m' instead of '%Y-%m-%d'
+        if int(date_str.split('-')[1]) > 12:
+            return date_str if return_string else datetime.strptime(date_str, '%Y-%d-%m').date()
+        else:
+            return date_str if return_string else datetime.strptime(date_str, str_pattern).date()
+    except (ValueError, re.error):
+        return np.nan
+
+
+def parse_dates(values):
+    """ Extract the first date of each value of a column, see parse_date.
+
+    Each distinct string is parsed only once, the memoized parse_date also shares the results between the columns.
+
+    Args:
+        values: Series of (free text) values, values that are no strings do not contain a date.
+
+    Returns:
+        np.ndarray: Array of datetime64[D] values, NaT if no (valid) date is found.
+
+    """
+    codes, strings = pd.factorize(values.where(values.map(type).eq(str)).astype(object))
+    dates = [parse_date(s) for s in strings]
+    # The last entry is used for the code -1 of values that are no strings
+    dates = [np.datetime64(d, 'D') if isinstance(d, date) else np.datetime64('NaT', 'D') for d in dates]
+    return np.array(dates + [np.datetime64('NaT', 'D')], dtype='datetime64[D]')[codes]
+
+
+comorbidities_base = 'Klinisch-anamnestische Information//Komorbiditäten aus Arztbrief'
+comorbidities_org = f'{comorbidities_base}::Andere Komorbiditäten'
+comorbidities_date = f'{comorbidities_base}::Datum'
+comorbidities_study_type = f'{comorbidities_base}::Untersuchungstyp'
+comorbidities_dia = f'{comorbidities_base}::Diastolischer Blutdruck'
+comorbidities_new = [comorbidities_date, comorbidities_study_type, comorbidities_dia]
+
+
+def get_day_offsets(values, baseline_dates):
+    """ Replace the dates of a column by the number of days relative to the baseline dates.
+
+    Args:
+        values: Series of (free text) values.
+        baseline_dates: Array of datetime64[D] baseline dates, one for each value.
+
+    Returns:
+        np.ndarray: Number of days, float values are kept and NaN if no date is found. The array is of integer type
+                    if there are no float values at all.
+
+    """
+    is_float = values.map(type).isin([float, np.float64]).to_numpy(dtype=bool)
+    differences = parse_dates(values) - baseline_dates
+    offsets = np.where(np.isnat(differences), np.nan, differences.astype('int64'))
+    offsets = np.where(is_float, pd.to_numeric(values.where(is_float), errors='coerce'), offsets)
+    if not is_float.any() and not np.isnan(offsets).any():
+        return offsets.astype('int64')
+    return offsets
+
+
+def update_date_columns(df, dc):
+    baseline_dates = pd.to_datetime(df['Baseline Date Calculated']).to_numpy().astype('datetime64[D]')
+    for col in dc:
+        df[col] = get_day_offsets(df[col], baseline_dates)
+    return df
+
+
+re_comorbidities_dia = re.compile(r'^(?:.*?dia#(\d{2,3})|.*?dia(\d{2,3}))', re.DOTALL)
+comorbidities_study_types = {'base': 'Baseline', 'ct': 'CT', 'zwi': 'Zwischenwert'}
+
+
+def extract_comorbidities_freetxt(df):
+    """ Extract date, study type and diastolic blood pressure from the free text field of other comorbidities.
+
+    The free text column is processed once with column-wide string operations, missing and unanswered values are
+    passed through without any string processing.
+
+    Args:
+        df: Dataframe containing the free text column and the column 'Baseline Date Calculated'.
+
+    Returns:
+        pd.DataFrame: Dataframe with the extracted columns in place of the free text column.
+
+    """
+    values = df[comorbidities_org].astype(object)
+    not_answered = (values == 'Nicht beantwortet').to_numpy(dtype=bool)
+    is_text = values.map(type).eq(str).to_numpy(dtype=bool) & ~not_answered
+    text = values[is_text]
+    lower_text = text.str.lower()
+
+    # Date relative to the baseline date
+    baseline_dates = pd.to_datetime(df['Baseline Date Calculated'][is_text]).to_numpy().astype('datetime64[D]')
+    differences = parse_dates(text) - baseline_dates
+    dates = np.full(len(values), np.nan)
+    dates[is_text] = np.where(np.isnat(differences), np.nan, differences.astype('int64'))
+
+    # Study types mentioned in the text, e.g. 'Baseline, CT'
+    study_types = pd.Series('', index=text.index, dtype=object)
+    for key, study_type in comorbidities_study_types.items():
+        study_types += lower_text.str.contains(key, regex=False).map({True: f'{study_type}, ', False: ''})
+    study_type_values = values.to_numpy(copy=True)
+    study_type_values[is_text] = study_types.str[:-2].to_numpy(dtype=object)
+    study_type_values[not_answered] = ''
+
+    # Diastolic blood pressure given as 'dia#<value>' or (if there is none) 'dia<value>'
+    dia = lower_text.str.extract(re_comorbidities_dia)
+    dia_values = values.to_numpy(copy=True)
+    dia_values[is_text] = dia[0].fillna(dia[1]).to_numpy(dtype=object)
+
+    df[comorbidities_date] = dates.astype('int64') if not np.isnan(dates).any() else dates
+    df[comorbidities_study_type] = pd.Series(study_type_values.tolist(), index=df.index)
+    df[comorbidities_dia] = pd.Series(dia_values.tolist(), index=df.index)
+
+    # Update column order
+    columns = df.columns.tolist()
+    for col in comorbidities_new:
+        columns.remove(col)
+    rel_index = columns.index(comorbidities_org)
+    new_col_order = columns[:rel_index] + comorbidities_new + columns[(rel_index + 1):]
+
+    return df[new_col_order]
+
+
+faulty_date_threshold = 90
+
+
+def get_faulty_dates(df, date_cols, threshold=faulty_date_threshold):
+    """ Find the values of the date columns that are more than threshold days after the baseline date.
+
+    All date columns are converted to numeric day offsets at once, values that are no numbers (e.g. dates that could
+    not be parsed) are ignored.
+
+    Args:
+        df: Dataframe with relative date columns, see update_date_columns.
+        date_cols: Date columns to check, columns missing in the dataframe are skipped.
+        threshold: Maximum number of days after the baseline date.
+
+    Returns:
+        pd.DataFrame: Long format table with the columns PatientID, column and offset, one row per faulty value.
+
+    """
+    columns = [col for col in date_cols if col in df.columns]
+    offsets = np.empty((len(df), len(columns)))
+    for i, col in enumerate(columns):
+        offsets[:, i] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    rows, cols = np.nonzero(offsets > threshold)
+    return pd.DataFrame({'PatientID': df['PatientID'].to_numpy()[rows],
+                         'column': np.array(columns, dtype=object)[cols],
+                         'offset': offsets[rows, cols]})
+
+
+def render_faulty_dates(faulty_dates, threshold=faulty_date_threshold):
+    """ Render the faulty date values as text, listing the affected date columns of each patient. """
+    lines = ['In diesem Dokument werden alle Patienten IDs aufgeführt, welche auffällige Werte in den verschiedenen '
+             'Datumsfeldern haben.\nAuffällig sind hier insbesondere Werte, welche einen Abstand von über '
+             f'{threshold:g} Tagen zum berechneten Baseline-Datum aufweisen.\nBitte überprüfen Sie diese IDs auf '
+             'Richtigkeit und führen Sie den Parser anschließend ggf. erneut aus.',
+             '',
+             'WICHTIG: Bitte teilen Sie dieses Dokument NICHT mit uns oder anderen Standorten, da durch die IDs '
+             'ansonsten personenbezogene Informationen geteilt werden.']
+    faulty_columns = faulty_dates.drop_duplicates(['PatientID', 'column'])
+    for patient_id, columns in faulty_columns.groupby('PatientID', sort=False)['column']:
+        lines += ['', f'ID: {patient_id}'] + [f'\t{col}' for col in columns] + ['-' * 80]
+    return '\n'.join(lines)
+
+
+def faulty_logs(faulty_dates, threshold=faulty_date_threshold, info_file='extraction_info.txt'):
+    """ Write the faulty date values as text report and as table next to it (<info_file>_dates.csv).
+
+    Args:
+        faulty_dates: Table of the faulty date values, see get_faulty_dates.
+        threshold: Maximum number of days after the baseline date used to find the values.
+        info_file: Path of the text report.
+
+    """
+    with open(info_file, 'w') as f:
+        f.write(render_faulty_dates(faulty_dates, threshold))
+    faulty_dates.to_csv(f'{os.path.splitext(info_file)[0]}_dates.csv', index=False)
+
+
+def anonymize(df, uids=None):
+    """ Replace the PatientIDs by their pseudonyms, PatientIDs without pseudonym get a new random UUID.
+
+    The pseudonyms are looked up once per distinct PatientID and mapped onto the column as a whole.
+    """
+    if uids is None:
+        uids = {}
+    replacements = {id_: uids[id_] if id_ in uids else uuid.uuid4() for id_ in df['PatientID'].unique()}
+    df['PatientID'] = df['PatientID'].map(replacements)
+    return df
+
+
+excel_max_rows = 1048576
+excel_max_cell_length = 32767
+csv_chunk_size = 10000
+sqlite_database_name = 'raw_data.sqlite'
+sqlite_batch_size = 10000
+sqlite_key_columns = (('PatientID', 'Template', 'AssessmentID'), ('PatientID', 'LesionID', 'Lesion_class'))
+sqlite_index_columns = ('PatientID', 'Template', 'AssessmentID')
+
+
+class ExcelStreamWriter:
+    """ Writes rows incrementally to an xlsx file using the write-only mode of openpyxl.
+
+    Every row is written as soon as it is appended instead of building the whole workbook in memory. Once a sheet
+    reaches the row limit of Excel, a new sheet with the same header is started. Text that exceeds the cell limit of
+    Excel is truncated or moved to a side file (CSV with sheet, cell, column and value), since Excel would otherwise
+    refuse to open the workbook.
+
+    Args:
+        out_file: Path of the xlsx file.
+        columns: Column names, written as header of each sheet.
+        sheet_name: Name of the first sheet, further sheets get a running number.
+        oversized_cells: 'move' to move oversized values to '<out_file>_oversized_cells.csv' or 'truncate'.
+    """
+
+    def __init__(self, out_file, columns, sheet_name='Sheet1', oversized_cells='move'):
+        self.out_file = out_file
+        self.columns = list(columns)
+        self.sheet_name = sheet_name
+        self.oversized_cells = oversized_cells
+        self.oversized_file = f'{os.path.splitext(out_file)[0]}_oversized_cells.csv'
+        self.oversized_handle = None
+        self.oversized_writer = None
+        self.n_oversized = 0
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheets = []
+        self.sheet = None
+        self.sheet_rows = 0
+
+    def add_sheet(self):
+        title = self.sheet_name if not self.sheets else f'{self.sheet_name} ({len(self.sheets) + 1})'
+        self.sheet = self.workbook.create_sheet(title=title[:31])
+        self.sheets.append(self.sheet)
+        self.sheet.append([self.convert_value(column, i) for i, column in enumerate(self.columns)])
+        self.sheet_rows = 1
+
+    def convert_value(self, value, column_index):
+        """ Convert a value to a type that can be written to a cell, as DataFrame.to_excel does. """
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or value is pd.NaT:
+            return None
+        if isinstance(value, float):
+            if value != value:
+                return None
+            if value in (np.inf, -np.inf):
+                return 'inf' if value > 0 else '-inf'
+            return value
+        if isinstance(value, pd.Timestamp):
+            return value.to_pydatetime()
+        if isinstance(value, (bool, int, date, timedelta)):
+            return value
+        value = ILLEGAL_CHARACTERS_RE.sub('', str(value))
+        if len(value) > excel_max_cell_length:
+            return self.handle_oversized_value(value, column_index)
+        return value
+
+    def handle_oversized_value(self, value, column_index):
+        self.n_oversized += 1
+        if self.oversized_cells == 'truncate':
+            return value[:excel_max_cell_length]
+        if self.oversized_writer is None:
+            self.oversized_handle = open(self.oversized_file, 'w', newline='', encoding='utf-8')
+            self.oversized_writer = csv.writer(self.oversized_handle)
+            self.oversized_writer.writerow(['Sheet', 'Cell', 'Column', 'Value'])
+        cell = f'{get_column_letter(column_index + 1)}{self.sheet_rows + 1}'
+        self.oversized_writer.writerow([self.sheet.title, cell, self.columns[column_index], value])
+        return f'[moved to {os.path.basename(self.oversized_file)}, sheet {self.sheet.title}, cell {cell}]'
+
+    def append(self, row):
+        """ Append a row given as sequence with one value for each column. """
+        if self.sheet is None or self.sheet_rows == excel_max_rows:
+            self.add_sheet()
+        self.sheet.append([self.convert_value(value, i) for i, value in enumerate(row)])
+        self.sheet_rows += 1
+
+    def close(self):
+        if self.sheet is None:
+            self.add_sheet()
+        self.workbook.save(self.out_file)
+        if self.oversized_handle is not None:
+            self.oversized_handle.close()
+        if len(self.sheets) > 1:
+            print(f'WARNING::{self.out_file} exceeds the row limit of Excel and was split into {len(self.sheets)} '
+                  f'sheets')
+        if self.n_oversized > 0:
+            action = f'moved to {self.oversized_file}' if self.oversized_cells == 'move' else 'truncated'
+            print(f'WARNING::{self.n_oversized} values exceed the cell limit of Excel and were {action}')
+
+
+def write_excel(df, out_file, index=False, sheet_name='Sheet1', oversized_cells='move'):
+    """ Write a dataframe row by row to an xlsx file, see ExcelStreamWriter.
+
+    Args:
+        df: Dataframe to write.
+        out_file: Path of the xlsx file.
+        index: Write the index as first column, as DataFrame.to_excel does by default.
+        sheet_name: Name of the first sheet.
+        oversized_cells: 'move' or 'truncate', see ExcelStreamWriter.
+
+    """
+    columns = ([df.index.name] if index else []) + list(df.columns)
+    writer = ExcelStreamWriter(out_file, columns, sheet_name=sheet_name, oversized_cells=oversized_cells)
+    for row in df.itertuples(index=index, name=None):
+        writer.append(row)
+    writer.close()
+
+
+def write_csv(df, out_file, index=False, sep=','):
+    """ Write a dataframe in chunks of rows to a delimited text file.
+
+    Args:
+        df: Dataframe to write.
+        out_file: Path of the text file.
+        index: Write the index as first column.
+        sep: Field delimiter.
+
+    """
+    df.to_csv(out_file, sep=sep, index=index, chunksize=csv_chunk_size, encoding='utf-8')
+
+
+def write_tsv(df, out_file, index=False):
+    """ Write a dataframe in chunks of rows to a tab separated text file, see write_csv. """
+    write_csv(df, out_file, index=index, sep='\t')
+
+
+def to_arrow_table(df, index=False):
+    """ Convert a dataframe to an arrow table and keep the column types.
+
+    Object columns are typed by arrow (strings, lists of numbers, ...), columns arrow cannot type because of mixed
+    values are stored as strings.
+
+    Args:
+        df: Dataframe to convert.
+        index: Keep the index as first column.
+
+    Returns:
+        Arrow table with one column per dataframe column.
+
+    """
+    if index:
+        df = df.reset_index()
+    arrays = []
+    for column in df.columns:
+        try:
+            arrays.append(pa.array(df[column], from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            arrays.append(pa.array([None if pd.api.types.is_scalar(value) and pd.isna(value) else str(value)
+                                    for value in df[column]], type=pa.string()))
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns])
+
+
+def write_parquet(df, out_file, index=False):
+    """ Write a dataframe with its column types to a parquet file, see to_arrow_table. """
+    pq.write_table(to_arrow_table(df, index=index), out_file)
+
+
+def write_feather(df, out_file, index=False):
+    """ Write a dataframe uncompressed to a feather (arrow IPC) file, so it can be memory-mapped when loaded. """
+    feather.write_feather(to_arrow_table(df, index=index), out_file, compression='uncompressed')
+
+
+def quote_identifier(name):
+    """ Quote a table or column name for SQLite. """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def get_sqlite_type(dtype):
+    """ SQLite column type of a dataframe column type. """
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def convert_sqlite_value(value):
+    """ Convert a cell to a value SQLite can store, missing values become NULL and lists are stored as JSON. """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if np.isnan(value) else value
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return json.dumps(np.asarray(value).tolist())
+    if value is pd.NaT:
+        return None
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def write_sqlite(df, out_file, index=False, table='data'):
+    """ Write a dataframe to a table of a SQLite database and update the rows of previous exports in place.
+
+    The rows are inserted with executemany in batches of sqlite_batch_size rows, each batch in its own transaction.
+    If the dataframe contains one of the sqlite_key_columns, the table gets a unique index on these columns and rows
+    with the same key replace the existing ones (missing key values are stored as empty strings, because SQLite
+    treats NULL values as distinct). Tables without key columns cannot be updated in place, so they are replaced by
+    the new rows, e.g. the normalized lesion tables whose keys only number the rows of a single export. Columns of
+    sqlite_index_columns are indexed to query single patients or templates. Columns missing in an existing table are
+    added.
+
+    Args:
+        df: Dataframe to write.
+        out_file: Path of the SQLite database, created if necessary.
+        index: Write the index as first column.
+        table: Name of the table.
+
+    """
+    if index:
+        df = df.reset_index()
+    columns = [str(column) for column in df.columns]
+    key_columns = next((keys for keys in sqlite_key_columns if all(key in columns for key in keys)), ())
+    key_positions = [columns.index(key) for key in key_columns]
+    connection = sqlite3.connect(out_file)
+    try:
+        with connection:
+            if not key_columns:
+                connection.execute(f'DROP TABLE IF EXISTS {quote_identifier(table)}')
+            column_definitions = ', '.join(f'{quote_identifier(column)} {get_sqlite_type(dtype)}'
+                                           for column, dtype in zip(columns, df.dtypes))
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({column_definitions})')
+            existing_columns = {row[1] for row in connection.execute(f'PRAGMA table_info({quote_identifier(table)})')}
+            for column, dtype in zip(columns, df.dtypes):
+                if column not in existing_columns:
+                    connection.execute(f'ALTER TABLE {quote_identifier(table)} ADD COLUMN {quote_identifier(column)} '
+                                       f'{get_sqlite_type(dtype)}')
+            if key_columns:
+                connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {quote_identifier(table + "_key")} ON '
+                                   f'{quote_identifier(table)} ({", ".join(map(quote_identifier, key_columns))})')
+            for column in sqlite_index_columns:
+                if column in columns:
+                    connection.execute(f'CREATE INDEX IF NOT EXISTS {quote_identifier(f"{table}_{column}")} ON '
+                                       f'{quote_identifier(table)} ({quote_identifier(column)})')
+
+        statement = (f'INSERT OR REPLACE INTO {quote_identifier(table)} ({", ".join(map(quote_identifier, columns))}) '
+                     f'VALUES ({", ".join("?" * len(columns))})')
+
+        def convert_row(row):
+            row = [convert_sqlite_value(value) for value in row]
+            for position in key_positions:
+                if row[position] is None:
+                    row[position] = ''
+            return row
+
+        rows = map(convert_row, df.itertuples(index=False, name=None))
+        for batch in iter(lambda: list(islice(rows, sqlite_batch_size)), []):
+            with connection:
+                connection.executemany(statement, batch)
+    finally:
+        connection.close()
+
+
+output_sinks = {'xlsx': write_excel, 'csv': write_csv, 'tsv': write_tsv, 'sqlite': write_sqlite,
+                'parquet': write_parquet, 'feather': write_feather}
+columnar_output_formats = ('parquet', 'feather')
+
+
+def get_output_formats():
+    """ Output formats that can be written, parquet and feather require pyarrow. """
+    return [output_format for output_format in output_sinks
+            if pa is not None or output_format not in columnar_output_formats]
+
+
+def histograms_to_lists(df):
+    """ Convert the histogram arrays to lists, numpy arrays would only be written shortened to text based outputs. """
+    for column in ['histogram_values', 'histogram_frequencies']:
+        if column in df.columns:
+            df[column] = df[column].map(lambda histogram: histogram.tolist())
+    return df
+
+
+def write_output(df, out_file, output_format='xlsx', index=False):
+    """ Write a dataframe with the sink of the output format.
+
+    Args:
+        df: Dataframe to write.
+        out_file: Path of the output file without extension, the output format is appended as extension. For
+            sqlite the file name is used as table name of sqlite_database_name in the same directory.
+        output_format: One of output_sinks.
+        index: Write the index as first column.
+
+    Returns:
+        Path of the written file.
+
+    """
+    if output_format in columnar_output_formats and pa is None:
+        raise ImportError(f'Output format {output_format} requires pyarrow')
+    if output_format not in columnar_output_formats:
+        df = histograms_to_lists(df)
+    if output_format == 'sqlite':
+        database = os.path.join(os.path.dirname(out_file), sqlite_database_name)
+        write_sqlite(df, database, index=index, table=os.path.basename(out_file))
+        return database
+    out_file = f'{out_file}.{output_format}'
+    output_sinks[output_format](df, out_file, index=index)
+    return out_file
+
+
+# Default percentiles and HU thresholds of the lesion histogram statistics
+histogram_percentiles = (10, 25, 50, 75, 90)
+histogram_hu_thresholds = (-950,)
+
+
+def get_histogram_statistics(values, frequencies, percentiles=histogram_percentiles,
+                             hu_thresholds=histogram_hu_thresholds):
+    """ Calculate the statistics of a histogram directly from the values and frequencies of its bins.
+
+    The results are the same as for the expanded histogram (each value repeated by its frequency), i.e. mean,
+    (population) standard deviation, skewness and excess kurtosis as in scipy.stats and percentiles as np.percentile.
+
+    Args:
+        values: Array of the bin values (HU).
+        frequencies: Array of the bin frequencies.
+        percentiles: Percentiles to calculate, in the range 0 to 100.
+        hu_thresholds: Thresholds for which the fraction of voxels below is calculated, e.g. -950 for emphysema.
+
+    Returns:
+        dict: Statistics with one column name each, NaN if the histogram is empty.
+
+    """
+    keep = frequencies > 0
+    order = np.argsort(values[keep], kind='stable')
+    values = values[keep][order]
+    frequencies = frequencies[keep][order]
+    n = frequencies.sum()
+    statistics = dict.fromkeys(['histogram_mean', 'histogram_std', 'histogram_skewness', 'histogram_kurtosis'] +
+                               [f'histogram_p{q:g}' for q in percentiles] +
+                               [f'histogram_below_{t:g}' for t in hu_thresholds], np.nan)
+    if n == 0:
+        return statistics
+
+    weights = frequencies / n
+    mean = np.dot(weights, values)
+    deviations = values - mean
+    variance = np.dot(weights, deviations ** 2)
+    statistics['histogram_mean'] = mean
+    statistics['histogram_std'] = np.sqrt(variance)
+    if variance > 0:
+        statistics['histogram_skewness'] = np.dot(weights, deviations ** 3) / variance ** 1.5
+        statistics['histogram_kurtosis'] = np.dot(weights, deviations ** 4) / variance ** 2 - 3
+
+    # Linear interpolation between the neighbouring voxels as np.percentile does on the expanded histogram
+    cumulative = np.cumsum(frequencies)
+    positions = (n - 1) * np.asarray(percentiles, dtype=np.float64) / 100
+    lower = np.floor(positions)
+    lower_values = values[np.searchsorted(cumulative, lower, side='right')]
+    upper_values = values[np.searchsorted(cumulative, np.minimum(lower + 1, n - 1), side='right')]
+    for q, value in zip(percentiles, lower_values + (positions - lower) * (upper_values - lower_values)):
+        statistics[f'histogram_p{q:g}'] = value
+
+    for t in hu_thresholds:
+        statistics[f'histogram_below_{t:g}'] = frequencies[values < t].sum() / n
+    return statistics
+
+
+def get_histogramm(lesion, expand=False, percentiles=histogram_percentiles, hu_thresholds=histogram_hu_thresholds):
+    """ Get the histogram of a lesion from its bins.
+
+    Args:
+        lesion: Lesion (XML element)
+        expand: Return the histogram as list that repeats the value of each bin by its frequency (as in previous
+                versions) instead of the arrays of values and frequencies.
+        percentiles: Percentiles to calculate, see get_histogram_statistics.
+        hu_thresholds: HU thresholds to calculate the fraction of voxels below, see get_histogram_statistics.
+
+    Returns:
+        tuple: Dictionary with the histogram columns, i.e. the statistics and 'histogram_values' (float) and
+               'histogram_frequencies' (int) arrays or the expanded 'histogram' list, and dictionary of the
+               histogram attributes.
+
+    """
+    histogram_attrib = {}
+    values = []
+    frequencies = []
+    for Histogram in lesion[1].iter('Histogram'):
+        # print (Histogram.attrib)
+        histogram_attrib = Histogram.attrib
+        for bin in Histogram.iter('Bin'):
+            values.append(bin.attrib['Value'])
+            frequencies.append(bin.attrib['Frequency'])
+    values = np.array(values, dtype=str).astype(np.float64)
+    frequencies = np.array(frequencies, dtype=str).astype(np.int64)
+    histogram_data = get_histogram_statistics(values, frequencies, percentiles=percentiles,
+                                              hu_thresholds=hu_thresholds)
+    if expand:
+        histogram_data['histogram'] = np.repeat(values, np.maximum(frequencies, 0)).tolist()
+    else:
+        histogram_data['histogram_values'] = values
+        histogram_data['histogram_frequencies'] = frequencies
+    return histogram_data, histogram_attrib
+
+
+histogram_bin_edges = np.arange(-1024.5, 1024.5 + 0.5, 1.0)
+histogram_metadata_columns = ['PatientID', 'LesionID', 'Lesion_class']
+npy_header_size = 128
+
+
+class HistogramMatrixWriter:
+    """ Writes the lesion histograms as dense float32 matrix (lesions x HU bins) to a .npy file.
+
+    The histograms of each case are binned and appended as soon as the case is extracted, so the matrix never needs
+    to be held in memory. The header is written with the final number of rows when the writer is closed, afterwards
+    the file can be loaded with np.load(matrix_file, mmap_mode='r'). Row i belongs to the i-th lesion of the
+    Digitale Stanze output, see write_histogram_metadata.
+    """
+
+    def __init__(self, matrix_file, bin_edges=histogram_bin_edges):
+        self.matrix_file = matrix_file
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.n_rows = 0
+        self.n_outside = 0
+        self.file = open(matrix_file, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        header = repr({'descr': '<f4', 'fortran_order': False, 'shape': (self.n_rows, len(self.bin_edges) - 1)})
+        header = header.ljust(npy_header_size - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self.file.seek(0, os.SEEK_END)
+
+    def add(self, lesions):
+        """ Bin the histograms of the given lesions (dictionaries as created by getCaseLesions) and append them. """
+        if len(lesions) == 0:
+            return
+        values, frequencies, rows = [], [], []
+        for row, lesion in enumerate(lesions):
+            if 'histogram_values' in lesion:
+                values.append(lesion['histogram_values'])
+                frequencies.append(np.maximum(lesion['histogram_frequencies'], 0))
+            else:
+                values.append(np.asarray(lesion['histogram'], dtype=np.float64))
+                frequencies.append(np.ones(len(values[-1]), dtype=np.int64))
+            rows.append(np.full(len(values[-1]), row, dtype=np.int64))
+        values = np.concatenate(values)
+        frequencies = np.concatenate(frequencies)
+        rows = np.concatenate(rows)
+
+        n_bins = len(self.bin_edges) - 1
+        bins = np.searchsorted(self.bin_edges, values, side='right') - 1
+        # The last edge belongs to the last bin, as in np.histogram
+        bins[values == self.bin_edges[-1]] = n_bins - 1
+        inside = (bins >= 0) & (bins < n_bins)
+        matrix = np.bincount(rows[inside] * n_bins + bins[inside], weights=frequencies[inside],
+                             minlength=len(lesions) * n_bins)
+        self.file.write(matrix.astype('<f4').tobytes())
+        self.n_rows += len(lesions)
+        self.n_outside += int(frequencies[~inside].sum())
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+        if self.n_outside > 0:
+            print(f'WARNING::{self.n_outside} voxels are outside of the histogram bin edges')
+
+
+def write_histogram_metadata(df, metadata_file):
+    """ Write the metadata of each row of the histogram matrix, i.e. the lesions in the order of the output. """
+    metadata = df[histogram_metadata_columns].reset_index(drop=True)
+    metadata.to_csv(metadata_file, index_label='row')
+
+
+covid_assessment_labels = ["COV-RADS Klassifikation*", "COVID-19 CT-morphologische Klassifikation",
+                           "CO-RADS Klassifikation", "Ausdehnung der Pneumonie"]
+
+# Columns of the normalized lesion tables, the remaining columns (histogram attributes and statistics) form the
+# histogram table
+lesion_case_columns = ['PatientID', 'DaysSinceBaseline', "Klassifikation des Lungenbefalls", "Nativ",
+                       *covid_assessment_labels]
+lesion_study_columns = ['StudyID', 'StudyDescription', 'SeriesDescription', 'SliceThickness', 'PixelSpacing']
+lesion_columns = ['Category', 'Lesion_class', 'LesionID', 'Organ']
+
+
+def get_table_keys(df, columns):
+    """ Number the distinct combinations of the given columns in order of appearance, missing values included. """
+    if not columns:
+        return pd.Series(0, index=df.index)
+    return df.groupby(columns, sort=False, dropna=False).ngroup()
+
+
+def normalize_lesions(df):
+    """ Split the Digitale Stanze lesion rows into a star schema of case, study, lesion and histogram tables.
+
+    The case level (patient, days since baseline and COVID assessment) and study level (DICOM) information is stored
+    once per distinct combination instead of being repeated on every lesion row. The lesion table refers to them by
+    CaseKey and StudyKey, the histogram table to the lesions by LesionKey, which is the row of the lesion in the flat
+    output (and the histogram matrix). The keys only number the rows of this export, so the tables have to be written
+    and replaced together.
+
+    Args:
+        df: Dataframe of the lesions as created from the records of getCaseLesions.
+
+    Returns:
+        dict: Dataframes with the keys cases, studies, lesions and histograms, see flatten_lesions.
+
+    """
+    df = df.reset_index(drop=True)
+    case_columns = [column for column in df.columns if column in lesion_case_columns]
+    study_columns = [column for column in df.columns if column in lesion_study_columns]
+    histogram_columns = [column for column in df.columns
+                         if column not in case_columns + study_columns + lesion_columns]
+    keys = pd.DataFrame({'LesionKey': df.index, 'CaseKey': get_table_keys(df, case_columns),
+                         'StudyKey': get_table_keys(df, study_columns)})
+    cases = pd.concat([keys['CaseKey'], df[case_columns]], axis=1).drop_duplicates('CaseKey', ignore_index=True)
+    studies = pd.concat([keys['StudyKey'], df[study_columns]], axis=1).drop_duplicates('StudyKey', ignore_index=True)
+    lesions = pd.concat([keys, df[[column for column in lesion_columns if column in df.columns]]], axis=1)
+    histograms = pd.concat([keys['LesionKey'], df[histogram_columns]], axis=1)
+    return {'cases': cases, 'studies': studies, 'lesions': lesions, 'histograms': histograms}
+
+
+def flatten_lesions(tables):
+    """ Rebuild the flat lesion rows (one row per lesion with all case, study and histogram columns) from the tables
+    of normalize_lesions.
+    """
+    df = tables['lesions'].merge(tables['cases'], on='CaseKey', how='left')
+    df = df.merge(tables['studies'], on='StudyKey', how='left')
+    df = df.merge(tables['histograms'], on='LesionKey', how='left').set_index('LesionKey').rename_axis(None)
+    # Column order of getCaseLesions, the case and study columns keep the order they were split off in
+    columns = dict.fromkeys(['PatientID', *lesion_columns, 'DaysSinceBaseline',
+                             *tables['studies'].columns.drop('StudyKey'), *tables['cases'].columns.drop('CaseKey'),
+                             *tables['histograms'].columns.drop('LesionKey')])
+    return df[[column for column in columns if column in df.columns]]
@@ -3,6 +3,10 @@ import pandas as pd
 from datetime import datetime
 from argparse import ArgumentParser
 import xml.etree.ElementTree as et
+import multiprocessing
+from functools import lru_cache
+from xml_parser_common import (ColumnAccumulator, compile_extraction_plan, get_assessment_id, get_output_formats,
+                               iter_case_batches, iter_cases, map_case_batches, sqlite_database_name, write_output)
 
 required_parameters = {
     "Arztbrief/KIS Angaben": {
@@ -228,20 +232,6 @@ required_parameters = {
 }
 
 
-def get_cases(r):
-    """ Get a list of all cases in an XML file with root r.
-    
-    Args:
-        r: root of the XML file
-    
-    Returns:
-        list: List of all cases.
-    """
-    return [case for trial in r.iter('Trial')
-            for trial_arm in trial.iter('TrialArm')
-            for case in trial_arm.iter('Case')]
-
-
 def create_dataframe(params):
     """ Create dataframe for collecting patient information.
     
@@ -249,15 +239,15 @@ def create_dataframe(params):
         params: Dictionary containing the names of the required parameters.
         
     Returns:
-        pd.Dataframe: Empty dataframe for case information.
+        ColumnAccumulator: Empty accumulator for case information, use to_dataframe() to obtain the dataframe.
     
     """
-    data_dict = {'PatientID': [], 'Template': []}
+    columns = ['PatientID', 'Template', 'AssessmentID']
     for template in list(params):
         for group in params[template]:
             for question in params[template][group]:
-                data_dict.update({f'{template}//{group}::{question}': []})
-    return pd.DataFrame(data_dict)
+                columns.append(f'{template}//{group}::{question}')
+    return ColumnAccumulator(columns)
 
 
 def encrypt_id(s):
@@ -266,10 +256,13 @@ def encrypt_id(s):
     return hash_string
 
 
+re_template_digit = re.compile(r'\([0-9]*\)')
+
+
+@lru_cache(maxsize=None)
 def clean_template_name(t, to_replace='RACOON COVID-19 '):
     t = t.replace(to_replace, '')
-    re_digit = re.compile(r'\([0-9]*\)')
-    search_digit = re_digit.search(t)
+    search_digit = re_template_digit.search(t)
     if search_digit:
         t = t.replace(f' {search_digit[0]}', '')
     return t
@@ -307,17 +300,19 @@ def get_column_order(template_order, params='required_parameters.json'):
     return [column for template in template_order for column in get_column_name_by_template(template, params)]
 
 
-def get_template_information(d, c, params, anonymization='UUID4'):
+def get_template_information(d, c, plan, anonymization='UUID4', unknown_templates=None):
     """ Extract all template information for a given case.
     
     Args:
-        d: Dataframe containing information about previous cases.
+        d: Accumulator containing information about previous cases.
         c: Current case (XML element)
-        params: Dictionary containing the names of the required parameters.
+        plan: Compiled extraction plan of the required parameters, see compile_extraction_plan.
         anonymization: Indicating whether to use SHA256 encryption or random UUIDs.
+        unknown_templates: Set collecting the templates that are not part of the required parameters, they are
+                           reported once after all cases.
         
     Returns:
-        pd.DataFrame: Dataframe containing update case information
+        ColumnAccumulator: Accumulator containing update case information
     
     """
     if anonymization == 'SHA256':
@@ -330,70 +325,133 @@ def get_template_information(d, c, params, anonymization='UUID4'):
     for j, template in enumerate(templates):
         try:
             template_name = clean_template_name(template.attrib['Header'])
-            template_dict = {'PatientID': patient_id, 'Template': template_name}
+            template_plan = plan.get(template_name)
+            if template_plan is None:
+                if unknown_templates is not None and template_name not in ['Behandlungsplan', 'Röntgen']:
+                    unknown_templates.add(template_name)
+                continue
+            values = d.new_row()
+            values[d.column_index['PatientID']] = patient_id
+            values[d.column_index['Template']] = template_name
+            values[d.column_index['AssessmentID']] = get_assessment_id(template, c.attrib.get('CaseID'), j)
             for group in template.iter('Group'):
-                group_name = group.attrib['Header']
-                if group_name in params[template_name]:
-                    for question in group.iter('Question'):
-                        question_name = question.attrib['Question']
-                        # if question_name == 'Alter':
-                        #     print(question_name)
-                        if question_name in params[template_name][group_name]:
-                            answer_name = question.attrib['Answer']
-                            template_dict.update({f'{template_name}//{group_name}::{question_name}': answer_name})
-            d = d.append(template_dict, ignore_index=True)
+                group_plan = template_plan.get(group.attrib['Header'])
+                if group_plan is None:
+                    continue
+                for question in group.iter('Question'):
+                    column_index = group_plan.get(question.attrib['Question'])
+                    if column_index is not None:
+                        values[column_index] = question.attrib['Answer']
+            d.append_values(values)
         except KeyError:
             template_name = clean_template_name(template.attrib['Header'])
-            if template_name not in ['Behandlungsplan', 'Röntgen']:
-                print(f'ERROR::KeyError with key {template_name}')
+            print(f'ERROR::KeyError with key {template_name}')
         # d = d.append(template_dict, ignore_index=True)
     return d
 
 
+worker_state = {}
+
+
+def init_worker(columns, plan, anonymization):
+    """ Store the extraction settings in a worker process. """
+    worker_state.update(columns=columns, plan=plan, anonymization=anonymization)
+
+
+def extract_case_batch(batch):
+    """ Extract a batch of serialized cases in a worker process.
+
+    Args:
+        batch: Tuple of the case indexes and a list of serialized cases, see iter_case_batches.
+
+    Returns:
+        tuple: Accumulator containing the information of the batch, list of (case index, error message) tuples and set
+               of the templates that are not part of the required parameters.
+
+    """
+    indexes, case_strings = batch
+    data = ColumnAccumulator(worker_state['columns'])
+    errors = []
+    unknown_templates = set()
+    for i, case_string in zip(indexes, case_strings):
+        if i % 50 == 0:
+            print(f'INFO::Currently handling case: {i + 1}')
+        try:
+            get_template_information(d=data, c=et.fromstring(case_string), plan=worker_state['plan'],
+                                     anonymization=worker_state['anonymization'], unknown_templates=unknown_templates)
+        except Exception as e:
+            errors.append((i, repr(e)))
+    return data, errors, unknown_templates
+
+
 def main(input_file='20211104_Mint_Export.xml',
          required_parameters='required_parameters.json',
-         anonymization='UUID4', template_order=None):
+         anonymization='UUID4', template_order=None, workers=1):
     # with open(required_parameters_file, encoding='utf-8') as json_file:
     #     required_parameters = json.load(json_file)
     if isinstance(required_parameters, str):
         with open(required_parameters, encoding='utf-8') as json_file:
             required_parameters = json.load(json_file)
 
-    print('INFO::Extracting tree and root objects from XML file')
-    tree = et.parse(input_file)
-    root = tree.getroot()
-
-    all_cases = get_cases(root)
-    n_cases = len(all_cases)
-
     data = create_dataframe(params=required_parameters)
+    plan = compile_extraction_plan(required_parameters, data)
+
+    errors = []
+    unknown_templates = set()
 
     print(f'INFO::Extracting case information')
-    for i, case in enumerate(all_cases):
-        if i % 50 == 0:
-            print(f'INFO::Currently handling case: {i + 1}/{n_cases}')
-        data = get_template_information(d=data, c=case, params=required_parameters, anonymization=anonymization)
+    if workers > 1:
+        print(f'INFO::Distributing cases over {workers} worker processes')
+        batches = iter_case_batches(iter_cases(input_file))
+        results = map_case_batches(batches, workers, extract_case_batch, init_worker,
+                                   (data.columns, plan, anonymization))
+        for partial_data, partial_errors, partial_templates in results:
+            data.extend(partial_data)
+            errors.extend(partial_errors)
+            unknown_templates.update(partial_templates)
+    else:
+        for i, case in enumerate(iter_cases(input_file)):
+            if i % 50 == 0:
+                print(f'INFO::Currently handling case: {i + 1}')
+            try:
+                data = get_template_information(d=data, c=case, plan=plan, anonymization=anonymization,
+                                                unknown_templates=unknown_templates)
+            except Exception as e:
+                errors.append((i, repr(e)))
+    for i, error in errors:
+        print(f'WARNING::Could not handle case {i + 1}: {error}')
+    for template_name in sorted(unknown_templates):
+        print(f'WARNING::Template {template_name} is not part of the required parameters')
+    data = data.to_dataframe()
 
     info = 'all'
     print("INFO::Data won't be filtered for certain patients")
 
     if template_order is not None:
-        data = data[['PatientID', 'Template'] + get_column_order(template_order, params=required_parameters)]
+        data = data[['PatientID', 'Template', 'AssessmentID'] + get_column_order(template_order, params=required_parameters)]
 
     return data, info
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for the case extraction')
+    parser.add_argument('--output-format', choices=get_output_formats(), default='xlsx',
+                        help=f'Format of the output files, sqlite tables are written to {sqlite_database_name}, '
+                             'parquet and feather require pyarrow')
+    cli_args = parser.parse_args()
+
     print('START::XML extraction started. This might take up to a few minutes...')
 
-    args = {'anonymization': 'UUID4'}
+    args = {'anonymization': 'UUID4', 'workers': cli_args.workers}
     print('INFO::Given arguments:')
     for k, v in args.items():
         print('\t', k, '->', v)
 
     script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
     print(f'INFO::Current working directory: {script_dir}')
-    xml_files = [file for file in os.listdir(script_dir) if '.xml' in file]
+    xml_files = [file for file in os.listdir(script_dir) if file.lower().endswith('.xml')]
 
     if len(xml_files) > 0:
         print(f'INFO::Processing file {xml_files[0]}')
@@ -401,9 +459,9 @@ if __name__ == '__main__':
         template_order = ['Arztbrief/KIS Angaben', 'Klinisch-anamnestische Information', 'Laborparameter', 'CT']
         data, info = main(input_file=xml_files[0], required_parameters=required_parameters, template_order=template_order, **args)
 
-        print('INFO::Save excel file')
-        out_file = os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation.xlsx',)
-        data.to_excel(out_file, index=False)
+        print(f'INFO::Save {cli_args.output_format} file')
+        out_file = write_output(data, os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation'),
+                                cli_args.output_format)
 
         print('DONE::XML extraction finished')
 
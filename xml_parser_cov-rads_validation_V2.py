@@ -1,9 +1,15 @@
-import json, hashlib, re, os, sys, uuid
+import json, hashlib, re, os, sys
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
 import xml.etree.ElementTree as et
+import multiprocessing
+from functools import lru_cache
+from xml_parser_common import (ColumnAccumulator, anonymize, compile_extraction_plan, extract_comorbidities_freetxt,
+                               faulty_date_threshold, faulty_logs, get_assessment_id, get_faulty_dates,
+                               get_output_formats, iter_case_batches, iter_cases, map_case_batches,
+                               sqlite_database_name, update_date_columns, write_output)
 
 required_parameters = {
     "Arztbrief/KIS Angaben": {
@@ -235,41 +241,6 @@ date_columns = ['CT//StudyDate',
                 'Laborparameter//Virologie::Datum des vorherigen RT-PCR-Tests'
                 ]
 
-comorbidities_base = 'Klinisch-anamnestische Information//Komorbiditäten aus Arztbrief'
-comorbidities_org = f'{comorbidities_base}::Andere Komorbiditäten'
-comorbidities_date = f'{comorbidities_base}::Datum'
-comorbidities_study_type = f'{comorbidities_base}::Untersuchungstyp'
-comorbidities_dia = f'{comorbidities_base}::Diastolischer Blutdruck'
-comorbidities_new = [comorbidities_date, comorbidities_study_type, comorbidities_dia]
-
-
-def extract_date(s, regex=r'\d{4}[.-]\d{1,2}[.-]\d{1,2}', str_pattern='%Y-%m-%d', return_string=False):
-    # Return np.nan if no date is found (in order to handle this column subsequently)
-    try:
-        match = re.search(regex, s)
-        # Handle date format '%d.%m.%Y' if '%Y-%m-%d' (or similar ones) cannot be found
-        if match is None:
-            match = re.search(r'\d{2}.\d{2}.\d{4}', s)
-            if match is None:
-                return np.nan
-            else:
-                date_str = match.group()
-                return date_str if return_string else datetime.strptime(date_str, '%d.%m.%Y').date()
-        date_str = match.group()
-        # Replace separator between year, month and date with '-'
-        date_str = date_str.replace('.', '-')
-        # If month digits are larger than 12, then we assume date pattern to be '%Y-%d-%m' instead of '%Y-%m-%d'
-        if int(date_str.split('-')[1]) > 12:
-            return date_str if return_string else datetime.strptime(date_str, '%Y-%d-%m').date()
-        else:
-            return date_str if return_string else datetime.strptime(date_str, str_pattern).date()
-    except TypeError:
-        return np.nan
-    except AttributeError:
-        return np.nan
-    except:
-        return np.nan
-
 
 def encrypt_id(s):
     hash_object = hashlib.sha256(s.encode())
@@ -277,29 +248,18 @@ def encrypt_id(s):
     return hash_string
 
 
+re_template_digit = re.compile(r'\([0-9]*\)')
+
+
+@lru_cache(maxsize=None)
 def clean_template_name(t):
     t = t.replace('RACOON COVID-19 ', '')
-    re_digit = re.compile(r'\([0-9]*\)')
-    search_digit = re_digit.search(t)
+    search_digit = re_template_digit.search(t)
     if search_digit:
         t = t.replace(f' {search_digit[0]}', '')
     return t
 
 
-def get_cases(r):
-    """ Get a list of all cases in an XML file with root r.
-
-    Args:
-        r: root of the XML file
-
-    Returns:
-        list: List of all cases.
-    """
-    return [case for trial in r.iter('Trial')
-            for trial_arm in trial.iter('TrialArm')
-            for case in trial_arm.iter('Case')]
-
-
 def create_empty_dataframe(params, additional_columns=None):
     """ Create dataframe for collecting patient information.
 
@@ -307,22 +267,31 @@ def create_empty_dataframe(params, additional_columns=None):
         params: Dictionary containing the names of the required parameters.
 
     Returns:
-        pd.Dataframe: Empty dataframe for case information.
+        ColumnAccumulator: Empty accumulator for case information, use to_dataframe() to obtain the dataframe.
 
     """
-    data_dict = {'PatientID': [], 'Template': []}
+    columns = ['PatientID', 'Template', 'AssessmentID']
     if additional_columns is not None:
-        for col in additional_columns:
-            data_dict.update({col: []})
+        columns.extend(additional_columns)
     for template in list(params):
         for group in params[template]:
             for question in params[template][group]:
-                data_dict.update({f'{template}//{group}::{question}': []})
-    return pd.DataFrame(data_dict)
+                columns.append(f'{template}//{group}::{question}')
+    return ColumnAccumulator(columns)
+
 
+def get_study_dates(r, study_dates_dict=None):
+    """ Collect the CT study date of every assessment below the given XML element.
+
+    Args:
+        r: XML element to search for assessments, e.g. a single case
+        study_dates_dict: Dictionary to add the study dates to. A new one is created if not given.
 
-def get_study_dates(r):
-    study_dates_dict = {}
+    Returns:
+        dict: Mapping of assessment ID to study date.
+    """
+    if study_dates_dict is None:
+        study_dates_dict = {}
     for assessment in r.iter('Assessment'):
         assessment_id = assessment.attrib['AssessmentID']
         dcm_studies = list(assessment.iter('DicomStudy'))
@@ -333,244 +302,210 @@ def get_study_dates(r):
         for dcm_study in dcm_studies:
             study_date = dcm_study.attrib['StudyDate']
             study_dates_dict.update({assessment_id: study_date})
-    return pd.DataFrame(study_dates_dict.items(), columns=['CT//AssessmentID', 'CT//StudyDate'])
+    return study_dates_dict
+
+
+def keep_patients_with_template(df, template):
+    """ Keep only the patients that have at least one row of the given template.
+
+    Args:
+        df: Dataframe containing the columns PatientID and Template.
+        template: Name of the template, e.g. 'CT'.
+
+    Returns:
+        pd.DataFrame: Rows of all patients having the template.
+
+    """
+    has_template = (df['Template'] == template).groupby(df['PatientID'], sort=False).any()
+    return df[df['PatientID'].isin(has_template.index[has_template])]
 
 
 def remove_non_ct_patients(df):
-    patients = df['PatientID'].unique().tolist()
-    non_ct = [patient for patient in patients if len(df[(df['PatientID'] == patient) & (df['Template'] == 'CT')]) == 0]
-    return df[~df['PatientID'].isin(non_ct)]
-
-
-def extract_earliest_ct_dates(cts):
-    earliest_ct_dates = {}
-    for patient, dates in cts.items():
-        if np.nan in dates:
-            dates.remove(np.nan)
-
-        if len(dates) > 0:
-            converted_dates = [datetime.strptime(t, '%Y-%m-%d') for t in dates]
-            earliest_date = min(converted_dates)
-            earliest_ct_dates[patient] = earliest_date
-        else:
-            print(f'WARNING::There is no CT date extracted for any CT of patient {patient}')
-    return earliest_ct_dates
-
-
-def extract_n_days(df, patients_list):
-    n_days = {}
-    for patient in patients_list:
-        patient_days = df[df['PatientID'] == patient][
-            'Arztbrief/KIS Angaben//Arztbrief/KIS Angaben::Tage seit Aufnahme'].unique().tolist()
-        if np.nan in patient_days:
-            patient_days.remove(np.nan)
-        # Assumption: If there is an empty string, we assume the number of days since admission to be 0
-        patient_days = [int(d) if d != '' else 0 for d in patient_days]
-        # In case there is an empty sequence of patient_days, i.e., there is no such number specified, we assume it to be 0
-        if len(patient_days) > 0:
-            n_days[patient] = min(patient_days)
-        else:
-            n_days[patient] = 0
-    return n_days
+    return keep_patients_with_template(df, 'CT')
 
 
-def calculate_baseline_date(df):
-    patients = df['PatientID'].unique().tolist()
-    ct_dates = {patient: df[df['PatientID'] == patient]['CT//StudyDate'].unique().tolist() for patient in patients}
+def extract_earliest_ct_dates(df):
+    """ Get the earliest CT study date of each patient.
+
+    Args:
+        df: Dataframe containing the columns PatientID and CT//StudyDate.
+
+    Returns:
+        tuple: Series mapping each patient with at least one CT study date to the earliest date and list of the
+               patients without any CT study date.
+
+    """
+    ct_dates = pd.to_datetime(df['CT//StudyDate'], format='%Y-%m-%d')
+    earliest_ct_dates = ct_dates.groupby(df['PatientID'], sort=False).min()
+    non_ct_date_patients = earliest_ct_dates.index[earliest_ct_dates.isna()].tolist()
+    if len(non_ct_date_patients) > 0:
+        print(f'WARNING::There is no CT date extracted for any CT of {len(non_ct_date_patients)} patients: '
+              f'{", ".join(str(patient) for patient in non_ct_date_patients)}')
+    return earliest_ct_dates.dropna(), non_ct_date_patients
+
+
+def extract_n_days(df):
+    """ Get the minimum number of days since admission of each patient, 0 if there is no such number specified.
+
+    Args:
+        df: Dataframe containing the columns PatientID and 'Tage seit Aufnahme'.
+
+    Returns:
+        pd.Series: Minimum number of days for each patient.
+
+    """
+    patient_days = df['Arztbrief/KIS Angaben//Arztbrief/KIS Angaben::Tage seit Aufnahme']
+    # Assumption: If there is an empty string, we assume the number of days since admission to be 0
+    patient_days = patient_days.replace('', 0)
+    patient_days = pd.to_numeric(patient_days, errors='coerce')
+    # In case there is an empty sequence of patient_days, i.e., there is no such number specified, we assume it to be 0
+    return patient_days.groupby(df['PatientID'], sort=False).min().fillna(0)
 
-    # Extract earliest date from list of CT dates
-    earliest_ct_dates = extract_earliest_ct_dates(ct_dates)
+
+def calculate_baseline_date(df):
+    # Extract earliest date from CT dates
+    earliest_ct_dates, non_ct_date_patients = extract_earliest_ct_dates(df)
 
     # Get minimum number of days since admission for each patient
-    n_days = extract_n_days(df, patients)
+    n_days = extract_n_days(df)
 
     # Calculate baseline date for each patient
-    baselines = {patient: earliest_ct_dates[patient] - timedelta(days=n_days[patient]) for patient in patients}
-
-    return baselines, pd.DataFrame(baselines.items(), columns=['PatientID', 'Baseline Date Calculated'])
-
-
-def get_time_difference(baseline, reference):
-    try:
-        if isinstance(reference, float):
-            return reference
-        return (reference - baseline).days
-    except TypeError:
-        return reference
-
-
-def replace_date(baseline_date, reference_value):
-    if isinstance(reference_value, float):
-        return reference_value
-    reference_date = extract_date(reference_value)
-    return get_time_difference(baseline_date, reference_date)
-
-
-def update_date_columns(df):
-    for col in date_columns:
-        df[col] = df.apply(lambda row: replace_date(row['Baseline Date Calculated'], row[col]), axis=1)
-    return df
-
-
-def extract_study_type(txt):
-    if isinstance(txt, float):
-        return txt
-    txt = txt.lower()
-    study_types = []
-    if 'base' in txt:
-        study_types.append('Baseline')
-    if 'ct' in txt:
-        study_types.append('CT')
-    if 'zwi' in txt:
-        study_types.append('Zwischenwert')
-    return ', '.join(study_types)
-
-
-def extract_dia(s):
-    try:
-        if s == 'Nicht beantwortet':
-            return s
-        s_mod = s.lower()
-        match = re.search(r'dia#\d{2,3}', s_mod)
-        if match is not None:
-            return match.group().replace('dia#', '')
-        match = re.search(r'dia\d{2,3}', s_mod)
-        if match is not None:
-            return match.group().replace('dia', '')
-        return np.nan
-    except TypeError:
-        return s
-    except AttributeError:
-        return s
-
-
-def extract_comorbidities_freetxt(df):
-    df[comorbidities_date] = df.apply(
-        lambda row: get_time_difference(row['Baseline Date Calculated'], extract_date(row[comorbidities_org])), axis=1)
-    df[comorbidities_study_type] = df.apply(lambda row: extract_study_type(row[comorbidities_org]), axis=1)
-    df[comorbidities_dia] = df.apply(lambda row: extract_dia(row[comorbidities_org]), axis=1)
-
-    # Update column order
-    columns = df.columns.tolist()
-    for col in comorbidities_new:
-        columns.remove(col)
-    rel_index = columns.index(comorbidities_org)
-    new_col_order = columns[:rel_index] + comorbidities_new + columns[(rel_index + 1):]
-
-    return df[new_col_order]
-
-
-def faulty_logs(df):
-    with open('extraction_info.txt', 'w') as f:
-        f.write(
-            'In diesem Dokument werden alle Patienten IDs aufgeführt, welche auffällige Werte in den verschiedenen Datumsfeldern haben.\nAuffällig sind hier insbesondere Werte, welche einen Abstand von über 90 Tagen zum berechneten Baseline-Datum aufweisen.\nBitte überprüfen Sie diese IDs auf Richtigkeit und führen Sie den Parser anschließend ggf. erneut aus.')
-        f.write(
-            '\n\nWICHTIG: Bitte teilen Sie dieses Dokument NICHT mit uns oder anderen Standorten, da durch die IDs ansonsten personenbezogene Informationen geteilt werden.')
-    faulty_dict = {}
-
-    for col in date_columns:
-        faulty_ids = set(df[df[col] > 90]['PatientID'])
-        if len(faulty_ids) > 0:
-            for id_ in faulty_ids:
-                if id_ in faulty_dict:
-                    faulty_dict[id_].append(col)
-                else:
-                    faulty_dict[id_] = [col]
-
-    with open('extraction_info.txt', 'a') as f:
-        for id_, columns in faulty_dict.items():
-            f.write(f'\n\nID: {id_}')
-            for col in columns:
-                f.write(f'\n\t{col}')
-            f.write('\n--------------------------------------------------------------------------------')
-
-    return df
-
-
-def anonymize(df, anonymization='UUID4'):
-    if anonymization == 'UUID4':
-        replacements = {id_: uuid.uuid4() for id_ in df['PatientID'].unique()}
-    df['PatientID'] = df.apply(lambda row: replacements[row['PatientID']], axis=1)
-    return df
-
-
-def get_template_information(d, c, params):
+    baselines = earliest_ct_dates - pd.to_timedelta(n_days.reindex(earliest_ct_dates.index), unit='D')
+    baseline_dates = baselines.rename('Baseline Date Calculated').rename_axis('PatientID').reset_index()
+
+    return baselines.to_dict(), baseline_dates, non_ct_date_patients
+
+
+# Columns added to the CT rows, see compile_extraction_plan
+ct_template_columns = {'CT': ['CT//AssessmentID', 'CT//StudyDate']}
+
+
+def get_template_information(d, c, plan):
     """ Extract all template information for a given case.
 
+    The CT study dates of the case are indexed once by assessment ID and attached to the CT rows as they are added.
+
     Args:
-        d: Dataframe containing information about previous cases.
+        d: Accumulator containing information about previous cases.
         c: Current case (XML element)
-        params: Dictionary containing the names of the required parameters.
+        plan: Compiled extraction plan of the required parameters, see compile_extraction_plan.
 
     Returns:
-        pd.DataFrame: Dataframe containing update case information
+        ColumnAccumulator: Accumulator containing update case information
 
     """
     patient_id = c[0].attrib['PatientID']
+    study_dates = get_study_dates(c) if 'CT' in plan else {}
     templates = list(c.iter('Task'))
     for j, template in enumerate(templates):
         try:
             template_name = clean_template_name(template.attrib['Header'])
-            if template_name not in params.keys():
+            template_plan = plan.get(template_name)
+            if template_plan is None:
                 continue
-            template_dict = {'PatientID': patient_id, 'Template': template_name}
+            values = d.new_row()
+            values[d.column_index['PatientID']] = patient_id
+            values[d.column_index['Template']] = template_name
+            values[d.column_index['AssessmentID']] = get_assessment_id(template, c.attrib.get('CaseID'), j)
             if template_name == 'CT':
-                template_dict.update({'CT//AssessmentID': template.attrib['AssessmentID']})
+                assessment_id = template.attrib['AssessmentID']
+                values[d.column_index['CT//AssessmentID']] = assessment_id
+                values[d.column_index['CT//StudyDate']] = study_dates.get(assessment_id, np.nan)
             for group in template.iter('Group'):
-                group_name = group.attrib['Header']
-                if group_name in params[template_name]:
-                    for question in group.iter('Question'):
-                        question_name = question.attrib['Question']
-                        if question_name in params[template_name][group_name]:
-                            answer_name = question.attrib['Answer']
-                            template_dict.update({f'{template_name}//{group_name}::{question_name}': answer_name})
-            d = d.append(template_dict, ignore_index=True)
+                group_plan = template_plan.get(group.attrib['Header'])
+                if group_plan is None:
+                    continue
+                for question in group.iter('Question'):
+                    column_index = group_plan.get(question.attrib['Question'])
+                    if column_index is not None:
+                        values[column_index] = question.attrib['Answer']
+            d.append_values(values)
         except KeyError:
             template_name = clean_template_name(template.attrib['Header'])
             print(f'ERROR::KeyError with key {template_name}')
     return d
 
 
+worker_state = {}
+
+
+def init_worker(columns, plan):
+    """ Store the extraction settings in a worker process. """
+    worker_state.update(columns=columns, plan=plan)
+
+
+def extract_case_batch(batch):
+    """ Extract a batch of serialized cases in a worker process.
+
+    Args:
+        batch: Tuple of the case indexes and a list of serialized cases, see iter_case_batches.
+
+    Returns:
+        tuple: Accumulator containing the information of the batch and list of (case index, error message) tuples.
+
+    """
+    indexes, case_strings = batch
+    data = ColumnAccumulator(worker_state['columns'])
+    errors = []
+    for i, case_string in zip(indexes, case_strings):
+        if i % 100 == 0:
+            print(f'INFO::Currently handling case: {i + 1}')
+        try:
+            case = et.fromstring(case_string)
+            get_template_information(d=data, c=case, plan=worker_state['plan'])
+        except Exception as e:
+            errors.append((i, repr(e)))
+    return data, errors
+
+
 def main(input_file,
          required_parameters,
          anonymization='UUID4',
-         additional_columns=None):
+         additional_columns=None,
+         workers=1,
+         faulty_date_threshold=faulty_date_threshold):
     if isinstance(required_parameters, str):
         with open(required_parameters, encoding='utf-8') as json_file:
             required_parameters = json.load(json_file)
 
-    print('INFO::Extracting tree and root objects from XML file')
-    tree = et.parse(input_file)
-    root = tree.getroot()
-
-    all_cases = get_cases(root)
-    n_cases = len(all_cases)
-
     data = create_empty_dataframe(params=required_parameters, additional_columns=additional_columns)
-
-    print(f'INFO::Extracting case information')
-    for i, case in enumerate(all_cases):
-        if i % 100 == 0:  # Maybe 100 instead of 50
-            print(f'INFO::Currently handling case: {i + 1}/{n_cases}')
-        data = get_template_information(d=data, c=case, params=required_parameters)
-
-    # Extract CT study dates
-    print('INFO::Extract CT study dates from XML file')
-    study_dates = get_study_dates(root)
-    data = pd.merge(left=data, right=study_dates, on='CT//AssessmentID', how='left')
+    plan = compile_extraction_plan(required_parameters, data, template_columns=ct_template_columns)
+    errors = []
+
+    print(f'INFO::Extracting case information and CT study dates')
+    if workers > 1:
+        print(f'INFO::Distributing cases over {workers} worker processes')
+        batches = iter_case_batches(iter_cases(input_file))
+        results = map_case_batches(batches, workers, extract_case_batch, init_worker, (data.columns, plan))
+        for partial_data, partial_errors in results:
+            data.extend(partial_data)
+            errors.extend(partial_errors)
+    else:
+        for i, case in enumerate(iter_cases(input_file)):
+            if i % 100 == 0:  # Maybe 100 instead of 50
+                print(f'INFO::Currently handling case: {i + 1}')
+            try:
+                data = get_template_information(d=data, c=case, plan=plan)
+            except Exception as e:
+                errors.append((i, repr(e)))
+    for i, error in errors:
+        print(f'WARNING::Could not handle case {i + 1}: {error}')
+    data = data.to_dataframe()
 
     # Remove patients without CT template
     data = remove_non_ct_patients(data)
 
     # Calculate baseline date for each patient
     print(f'INFO::Calculate baseline date for each patient')
-    baselines, baseline_dates = calculate_baseline_date(data)
+    baselines, baseline_dates, non_ct_date_patients = calculate_baseline_date(data)
+    # Drop CTs that do not have a CT study date
+    data = data[~data['PatientID'].isin(non_ct_date_patients)]
     data = pd.merge(left=data, right=baseline_dates, on='PatientID', how='left')
     data['Baseline Date Calculated'] = pd.to_datetime(data['Baseline Date Calculated']).apply(lambda x: x.date())
 
     # Update date columns relatively
     print(f'INFO::Update date columns to relative time difference to baseline date')
-    data = update_date_columns(data)
+    data = update_date_columns(data, date_columns)
 
     # Extract data from 3.20 freetext field
     print(f"INFO::Extract data from 'other comorbidities'")
@@ -582,10 +517,10 @@ def main(input_file,
 
     # Move column CT//StudyDate
     ct_study_date = data.pop('CT//StudyDate')
-    data.insert(loc=5, column='CT//StudyDate', value=ct_study_date)
+    data.insert(loc=6, column='CT//StudyDate', value=ct_study_date)
 
     # Logging for faulty date columns
-    data = faulty_logs(data)
+    faulty_logs(get_faulty_dates(data, date_columns, threshold=faulty_date_threshold), threshold=faulty_date_threshold)
 
     # Anonymize data
     data = anonymize(data)
@@ -597,16 +532,27 @@ def main(input_file,
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for the case extraction')
+    parser.add_argument('--output-format', choices=get_output_formats(), default='xlsx',
+                        help=f'Format of the output files, sqlite tables are written to {sqlite_database_name}, '
+                             'parquet and feather require pyarrow')
+    parser.add_argument('--faulty-date-threshold', type=float, default=faulty_date_threshold,
+                        help='Report date values more than this number of days after the baseline date')
+    cli_args = parser.parse_args()
+
     print('START::XML extraction started. This might take up to a few minutes...')
 
-    args = {'anonymization': 'UUID4', 'additional_columns': ['CT//AssessmentID']}
+    args = {'anonymization': 'UUID4', 'additional_columns': ['CT//AssessmentID'], 'workers': cli_args.workers,
+            'faulty_date_threshold': cli_args.faulty_date_threshold}
     print('INFO::Given arguments:')
     for k, v in args.items():
         print('\t', k, '->', v)
 
     script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
     print(f'INFO::Current working directory: {script_dir}')
-    xml_files = [file for file in os.listdir(script_dir) if '.xml' in file]
+    xml_files = [file for file in os.listdir(script_dir) if file.lower().endswith('.xml')]
 
     if len(xml_files) > 0:
         print(f'INFO::Processing file {xml_files[0]}')
@@ -614,9 +560,9 @@ if __name__ == '__main__':
         start = datetime.now()
         data, info = main(input_file=xml_files[0], required_parameters=required_parameters, **args)
 
-        print('INFO::Save excel file')
-        out_file = os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation.xlsx')
-        data.to_excel(out_file, index=False)
+        print(f'INFO::Save {cli_args.output_format} file')
+        out_file = write_output(data, os.path.join(script_dir, f'{info}_raw_data_cov-rads-validation'),
+                                cli_args.output_format)
 
         print('DONE::XML extraction finished')
 
@@ -2,22 +2,17 @@
 import xml.etree.ElementTree as et
 import os
 import pandas as pd
+import numpy as np
 import hashlib
 import string
 import random
 import argparse
 import uuid
+import multiprocessing
+from functools import lru_cache
+from xml_parser_common import HistogramMatrixWriter, covid_assessment_labels, get_histogramm, get_output_formats, histogram_hu_thresholds, histogram_percentiles, iter_case_batches, iter_cases, map_case_batches, normalize_lesions, sqlite_database_name, write_histogram_metadata, write_output
 
 
-# parse cases as list
-def getAllCases() -> list:
-    cases = []
-    for trial in root.iter('Trial'):
-        for trialArm in trial.iter('TrialArm'):
-            for case in trialArm.iter('Case'):
-                cases.append(case)
-    return cases
-
 # parse reference measurement of air pre-sternal
 def getpresternal(referenzmessung):
     stanze = []
@@ -26,42 +21,30 @@ def getpresternal(referenzmessung):
             stanze.append(genericMeasurements)
     return stanze
 
+# pseudonymous StudyID (sha256 of StudyUID and StudyDate), many lesions share a study so each study is hashed once
+@lru_cache(maxsize=None)
+def get_study_id(study_uid, study_date):
+    return encrypt(study_uid + study_date)
+
 # parse dicom tag information from which the lesion was measured
+# only the last measurement record of a lesion is used, empty if it has no record
 def get_dicom_info(lesion):
-    dicom_information = {}
-
+    MeasurementRecord = None
     for MeasurementRecord in lesion[1].iter('MeasurementRecord'):
-        StudyDescription = MeasurementRecord.attrib['StudyDescription']
-        SeriesDescription = MeasurementRecord.attrib['SeriesDescription']         
-        SliceThickness = MeasurementRecord.attrib['SliceThickness']
-        PixelSpacing = MeasurementRecord.attrib['PixelSpacing0']
-        string2hash = MeasurementRecord.attrib['StudyUID'] + MeasurementRecord.attrib['StudyDate']
-        StudyID = encrypt(string2hash)
-
-        dicom_information = dict(StudyID = StudyID,
-                        StudyDescription = StudyDescription,
-                        SeriesDescription = SeriesDescription,
-                        SliceThickness = SliceThickness,
-                        PixelSpacing = PixelSpacing)
-    return dicom_information
-
-# takes the histogramm in the form of Bins, Frequency, Value to make a histogramm list.
-def get_histogramm(lesion):
-    histogram_attrib = {}
-    histogram_data = []
-    for Histogram in lesion[1].iter('Histogram'):
-    #print (Histogram.attrib)
-        histogram_attrib = Histogram.attrib
-        #histogram_data = []
-        for bin in Histogram.iter('Bin'):
-            for i in range(int(bin.attrib['Frequency'])):
-                histogram_data.append(float(bin.attrib['Value']))
-    return histogram_data, histogram_attrib 
+        pass
+    if MeasurementRecord is None:
+        return {}
+    attrib = MeasurementRecord.attrib
+    return dict(StudyID = get_study_id(attrib['StudyUID'], attrib['StudyDate']),
+                StudyDescription = attrib['StudyDescription'],
+                SeriesDescription = attrib['SeriesDescription'],
+                SliceThickness = attrib['SliceThickness'],
+                PixelSpacing = attrib['PixelSpacing0'])
 
 # parse information regarding covid assessment
 def get_covid_assessment(case):
     covid_assessment = {}
-    label_list = ["COV-RADS Klassifikation*","COVID-19 CT-morphologische Klassifikation", "CO-RADS Klassifikation", "Ausdehnung der Pneumonie"]
+    label_list = covid_assessment_labels
 
     for Question in case.iter('Question'):
         try:
@@ -116,7 +99,7 @@ def get_random_characters():
     return characters
 
 # sorry for the mess and ifs
-def getCaseLesions(case, testing= False):
+def getCaseLesions(case, testing= False, expand_histograms= False, percentiles= histogram_percentiles, hu_thresholds= histogram_hu_thresholds):
     lesion_list = []
     lesion_class = ''
     
@@ -151,7 +134,7 @@ def getCaseLesions(case, testing= False):
                     if testing == True:
                         print (lesion_class)
 
-            histogram_data, histogram_attrib = get_histogramm(lesion)
+            histogram_data, histogram_attrib = get_histogramm(lesion, expand_histograms, percentiles, hu_thresholds)
 
             case_lesion = dict(PatientID = hash_string,
                                 Category = Category,
@@ -163,7 +146,7 @@ def getCaseLesions(case, testing= False):
             case_lesion.update(dicom_info)
             case_lesion.update(covid_assessment)
             case_lesion.update(histogram_attrib)
-            case_lesion['histogram'] = histogram_data
+            case_lesion.update(histogram_data)
             lesion_list.append(case_lesion)
 
         # run almost same script on child tree for presternal reference value
@@ -175,7 +158,7 @@ def getCaseLesions(case, testing= False):
                     print (lesion_class)
 
                 dicom_info = get_dicom_info(referenzmessung_presternal)
-                histogram_data, histogram_attrib = get_histogramm(referenzmessung_presternal)
+                histogram_data, histogram_attrib = get_histogramm(referenzmessung_presternal, expand_histograms, percentiles, hu_thresholds)
                 case_lesion = dict(PatientID = hash_string,
                                 Category = Category,
                                 Lesion_class = lesion_class,
@@ -187,7 +170,7 @@ def getCaseLesions(case, testing= False):
                 case_lesion.update(dicom_info)
                 case_lesion.update(covid_assessment)
                 case_lesion.update(histogram_attrib)
-                case_lesion['histogram'] = histogram_data
+                case_lesion.update(histogram_data)
                 lesion_list.append(case_lesion)
     return lesion_list
 
@@ -204,11 +187,34 @@ def randomize_patient_ids(lesion_list) :
     
     return lesion_list
 
+# extract a batch of serialized cases in a worker process, errors are collected together with the case index
+def extract_case_batch(batch, histogram_options):
+    indexes, case_strings = batch
+    lesion_list = []
+    exception_list = []
+    for i, case_string in zip(indexes, case_strings):
+        try:
+            case_lesions = getCaseLesions(et.fromstring(case_string), **histogram_options)
+            lesion_list.extend(case_lesions)
+        except Exception as e:
+            exception_list.append((i, repr(e)))
+    return lesion_list, exception_list
+
+
 # %%
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser()
     parser.add_argument('--random_ids', help='Uses random, disposed uids for patients', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for the case extraction')
+    parser.add_argument('--expand_histograms', help='Writes each histogram as list of all voxel values instead of bin values and frequencies', action='store_true')
+    parser.add_argument('--percentiles', help='Percentiles of the histograms', nargs='*', type=float, default=histogram_percentiles)
+    parser.add_argument('--histogram_matrix', help='Also writes the histograms as float32 matrix (lesions x HU bins) to a .npy file with a metadata table', action='store_true')
+    parser.add_argument('--bin_edges', help='HU bin edges of the histogram matrix', nargs=3, type=float, default=(-1024.5, 1024.5, 1.0), metavar=('START', 'STOP', 'WIDTH'))
+    parser.add_argument('--output_format', help=f'Format of the output file, sqlite tables are written to {sqlite_database_name}, parquet and feather require pyarrow', choices=get_output_formats(), default='xlsx')
+    parser.add_argument('--hu_thresholds', help='HU thresholds for the fraction of voxels below', nargs='*', type=float, default=histogram_hu_thresholds)
+    parser.add_argument('--lesion_tables', help='Writes separate case, study, lesion and histogram tables joined by keys instead of one flat table', action='store_true')
     args = parser.parse_args()
 
     # process first xml file found in the script folder
@@ -218,32 +224,56 @@ if __name__ == "__main__":
 
     print(script_dir)
     for file in os.listdir(script_dir):
-        if ".xml" in file:
+        if file.lower().endswith(".xml"):
             xml_file.append(file)
 
     input_file = os.path.join(script_dir, xml_file[0])
-    out_file = os.path.join(script_dir, 'lesion_histogram_list2.xlsx')
     print (f"processing {xml_file[0]}")
     print ('this may take some time - grab yourself a coffee!')
-    tree = et.parse(input_file)
-    root = tree.getroot()
-    cases = getAllCases()
-
     lesion_list = []
     exception_list = []
-
-    for case in cases:
-        try:
-            case_lesions = getCaseLesions(case)
+    histogram_writer = None
+    if (args.histogram_matrix) :
+        start_edge, stop_edge, bin_width = args.bin_edges
+        histogram_writer = HistogramMatrixWriter(os.path.join(script_dir, 'lesion_histogram_matrix2.npy'), np.arange(start_edge, stop_edge + bin_width / 2, bin_width))
+    histogram_options = dict(expand_histograms=args.expand_histograms, percentiles=args.percentiles, hu_thresholds=args.hu_thresholds)
+
+    if args.workers > 1:
+        print (f'distributing cases over {args.workers} worker processes')
+        batches = iter_case_batches(iter_cases(input_file))
+        for case_lesions, case_exceptions in map_case_batches(batches, args.workers, extract_case_batch, args=(histogram_options,)):
             lesion_list.extend(case_lesions)
-        except Exception as e:
-            exception_list.append(e)
+            exception_list.extend(case_exceptions)
+            if histogram_writer is not None:
+                histogram_writer.add(case_lesions)
+    else:
+        for i, case in enumerate(iter_cases(input_file)):
+            try:
+                case_lesions = getCaseLesions(case, **histogram_options)
+                lesion_list.extend(case_lesions)
+                if histogram_writer is not None:
+                    histogram_writer.add(case_lesions)
+            except Exception as e:
+                exception_list.append((i, repr(e)))
+
+    for i, e in exception_list:
+        print (f'could not handle case {i}: {e}')
 
     if (args.random_ids) :
         lesion_list = randomize_patient_ids(lesion_list)
 
     df = pd.DataFrame.from_records(lesion_list)
-    df.to_excel(out_file)
-    print (f'{out_file} written successfully')
+    if histogram_writer is not None:
+        histogram_writer.close()
+        metadata_file = os.path.join(script_dir, 'lesion_histogram_matrix2_metadata.csv')
+        write_histogram_metadata(df, metadata_file)
+        print (f'{histogram_writer.matrix_file} and {metadata_file} written successfully')
+    if (args.lesion_tables) :
+        for name, table in normalize_lesions(df).items():
+            out_file = write_output(table, os.path.join(script_dir, f'lesion_histogram_list2_{name}'), args.output_format)
+            print (f'{out_file} written successfully')
+    else:
+        out_file = write_output(df, os.path.join(script_dir, 'lesion_histogram_list2'), args.output_format, index=True)
+        print (f'{out_file} written successfully')
 
 # %%